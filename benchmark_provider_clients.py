@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Provider client 复用基准测试
+对比每次调用新建连接 与 共享 lightrag.llm 客户端 (keep-alive) 的单次调用耗时
+
+用法:
+    python benchmark_provider_clients.py              # 本地自签名 HTTPS 服务 (含 TLS 握手)
+    python benchmark_provider_clients.py --url URL    # 真实 endpoint, 任何 HTTP 状态码都计入
+"""
+
+import argparse
+import asyncio
+import os
+import ssl
+import subprocess
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+from lightrag.llm import aclose_provider_clients, get_http_session
+
+
+def make_self_signed_cert(directory):
+    """用 openssl 生成临时自签名证书, 没有 openssl 时返回 None"""
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    try:
+        subprocess.run(
+            [
+                "openssl",
+                "req",
+                "-x509",
+                "-newkey",
+                "rsa:2048",
+                "-nodes",
+                "-keyout",
+                key,
+                "-out",
+                cert,
+                "-days",
+                "1",
+                "-subj",
+                "/CN=localhost",
+            ],
+            check=True,
+            capture_output=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return cert, key
+
+
+async def start_local_server(cert_pair):
+    """启动返回空 embedding 结果的本地服务"""
+
+    async def handle(request):
+        await request.read()
+        return web.json_response({"data": []})
+
+    app = web.Application()
+    app.router.add_route("*", "/v1/embeddings", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+
+    server_ssl = None
+    if cert_pair:
+        server_ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_ssl.load_cert_chain(*cert_pair)
+    site = web.TCPSite(runner, "127.0.0.1", 0, ssl_context=server_ssl)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    scheme = "https" if cert_pair else "http"
+    return runner, f"{scheme}://127.0.0.1:{port}/v1/embeddings"
+
+
+async def call_with_new_session(url, client_ssl):
+    """旧实现: 每次调用新建 ClientSession, 每次都要 TCP/TLS 握手"""
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            url, json={"input": ["hi"]}, ssl=client_ssl
+        ) as response:
+            await response.read()
+
+
+async def call_with_shared_session(url, client_ssl):
+    """新实现: 共享客户端, 复用 keep-alive 连接"""
+    async with get_http_session().post(
+        url, json={"input": ["hi"]}, ssl=client_ssl
+    ) as response:
+        await response.read()
+
+
+async def measure(call, url, client_ssl, calls):
+    await call(url, client_ssl)  # 预热 (DNS, 首次连接)
+    start = time.perf_counter()
+    for _ in range(calls):
+        await call(url, client_ssl)
+    return (time.perf_counter() - start) / calls * 1000
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", help="真实 endpoint, 默认使用本地 HTTPS 服务")
+    parser.add_argument("--calls", type=int, default=200, help="每种方式的调用次数")
+    args = parser.parse_args()
+
+    runner = None
+    client_ssl = None
+    url = args.url
+    with tempfile.TemporaryDirectory() as tmp:
+        if url is None:
+            cert_pair = make_self_signed_cert(tmp)
+            if cert_pair is None:
+                print("⚠️  未找到 openssl, 使用 HTTP (只含 TCP 握手)")
+            else:
+                client_ssl = ssl.create_default_context(cafile=cert_pair[0])
+                client_ssl.check_hostname = False
+            runner, url = await start_local_server(cert_pair)
+
+        print(f"🔍 {url}, 每种方式 {args.calls} 次调用")
+        fresh_ms = await measure(call_with_new_session, url, client_ssl, args.calls)
+        shared_ms = await measure(call_with_shared_session, url, client_ssl, args.calls)
+        await aclose_provider_clients()
+        if runner is not None:
+            await runner.cleanup()
+
+    print(f"每次新建连接: {fresh_ms:.2f} ms/次")
+    print(f"共享客户端:   {shared_ms:.2f} ms/次")
+    print(
+        f"✅ 每次调用节省 {fresh_ms - shared_ms:.2f} ms ({1 - shared_ms / fresh_ms:.0%})"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
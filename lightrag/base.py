@@ -1,14 +1,23 @@
+import asyncio
 from dataclasses import dataclass, field
 from typing import TypedDict, Union, Literal, Generic, TypeVar, Optional, Dict, Any
 from enum import Enum
 
 import numpy as np
 
-from .utils import EmbeddingFunc
+from .prompt import GRAPH_FIELD_SEP
+from .utils import EmbeddingFunc, split_string_by_multi_markers
 
 TextChunkSchema = TypedDict(
     "TextChunkSchema",
-    {"tokens": int, "content": str, "full_doc_id": str, "chunk_order_index": int},
+    {
+        "tokens": int,
+        "content": str,
+        "full_doc_id": str,
+        "chunk_order_index": int,
+        "start_char": int,
+        "end_char": int,
+    },
 )
 
 T = TypeVar("T")
@@ -31,6 +40,85 @@ class QueryParam:
     max_token_for_global_context: int = 4000
     # Number of tokens for the entity descriptions
     max_token_for_local_context: int = 4000
+    # Total tokens for entities, relations and sources together, allocated by
+    # relevance per token; 0 keeps the three budgets above
+    max_token_for_context: int = 0
+    # Mix mode only: probe the vector stores with the raw query and warm graph
+    # reads while keyword extraction is still running. Costs two extra vector
+    # queries per query, worth it when the graph backend is remote
+    speculative_retrieval: bool = False
+
+
+@dataclass
+class EntityContext:
+    """An entity in the query context"""
+
+    entity_name: str
+    entity_type: str = "UNKNOWN"
+    description: str = "UNKNOWN"
+    rank: int = 0
+    description_tokens: Optional[int] = None
+
+    @property
+    def id(self) -> str:
+        return self.entity_name
+
+
+@dataclass
+class RelationContext:
+    """A relation in the query context"""
+
+    src_id: str
+    tgt_id: str
+    description: str
+    keywords: str
+    weight: float
+    rank: int = 0
+    created_at: Any = None
+    description_tokens: Optional[int] = None
+
+    @property
+    def id(self) -> tuple[str, str]:
+        return tuple(sorted((self.src_id, self.tgt_id)))
+
+
+@dataclass
+class SourceContext:
+    """A text chunk in the query context"""
+
+    id: str
+    content: str
+    tokens: Optional[int] = None
+
+
+@dataclass
+class QueryContext:
+    """Entities, relations and sources retrieved for a query, rendered into the prompt once"""
+
+    entities: list[EntityContext] = field(default_factory=list)
+    relations: list[RelationContext] = field(default_factory=list)
+    sources: list[SourceContext] = field(default_factory=list)
+
+    def merge(self, other: "QueryContext") -> "QueryContext":
+        """Records of self followed by the records of other not already present, by id"""
+
+        def _merge(first: list, second: list) -> list:
+            seen = {record.id for record in first}
+            merged = list(first)
+            for record in second:
+                if record.id not in seen:
+                    seen.add(record.id)
+                    merged.append(record)
+            return merged
+
+        return QueryContext(
+            entities=_merge(self.entities, other.entities),
+            relations=_merge(self.relations, other.relations),
+            sources=_merge(self.sources, other.sources),
+        )
+
+    def is_empty(self) -> bool:
+        return not (self.entities or self.relations or self.sources)
 
 
 @dataclass
@@ -131,6 +219,43 @@ class BaseGraphStorage(StorageNameSpace):
     async def embed_nodes(self, algorithm: str) -> tuple[np.ndarray, list[str]]:
         raise NotImplementedError("Node embedding is not used in lightrag.")
 
+    async def get_nodes_chunk_ids(self, node_ids: list[str]) -> list[list[str]]:
+        """Chunk ids each node was extracted from, aligned with node_ids.
+
+        Falls back to splitting the stored source_id, backends that keep a
+        chunk adjacency index should override this.
+        """
+        nodes = await asyncio.gather(*[self.get_node(node_id) for node_id in node_ids])
+        return [_split_source_id(node) for node in nodes]
+
+    async def get_edges_chunk_ids(
+        self, edges: list[tuple[str, str]]
+    ) -> list[list[str]]:
+        """Chunk ids each edge was extracted from, aligned with edges"""
+        edge_datas = await asyncio.gather(
+            *[self.get_edge(src, tgt) for src, tgt in edges]
+        )
+        return [_split_source_id(edge) for edge in edge_datas]
+
+    async def get_chunks_graph_elements(
+        self, chunk_ids: list[str]
+    ) -> tuple[set[str], set[tuple[str, str]]]:
+        """Nodes and edges that reference any of chunk_ids.
+
+        There is no generic way to scan a backend's elements, backends that
+        support deletion by document must override this.
+        """
+        raise NotImplementedError(
+            f"Deletion by document is unsupported for {type(self).__name__}: "
+            "it does not implement get_chunks_graph_elements"
+        )
+
+
+def _split_source_id(data: Union[dict, None]) -> list[str]:
+    if not data or not data.get("source_id"):
+        return []
+    return split_string_by_multi_markers(data["source_id"], [GRAPH_FIELD_SEP])
+
 
 class DocStatus(str, Enum):
     """Document processing status enum"""
@@ -141,6 +266,14 @@ class DocStatus(str, Enum):
     FAILED = "failed"
 
 
+class ChunkStatus(str, Enum):
+    """Chunk entity extraction status enum"""
+
+    PENDING = "pending"
+    EXTRACTED = "extracted"
+    MERGED = "merged"
+
+
 @dataclass
 class DocProcessingStatus:
     """Document processing status data structure"""
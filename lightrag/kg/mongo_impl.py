@@ -25,14 +25,18 @@ class MongoKVStorage(BaseKVStorage):
         return self._data.find_one({"_id": id})
 
     async def get_by_ids(self, ids, fields=None):
+        """Fetch all ids with one $in query, results are aligned with ids"""
+        if not ids:
+            return []
         if fields is None:
-            return list(self._data.find({"_id": {"$in": ids}}))
-        return list(
-            self._data.find(
+            docs = self._data.find({"_id": {"$in": ids}})
+        else:
+            docs = self._data.find(
                 {"_id": {"$in": ids}},
                 {field: 1 for field in fields},
             )
-        )
+        docs_by_id = {doc["_id"]: doc for doc in docs}
+        return [docs_by_id.get(id) for id in ids]
 
     async def filter_keys(self, data: list[str]) -> set[str]:
         existing_ids = [
@@ -198,7 +198,9 @@ class PGKVStorage(BaseKVStorage):
 
     # Query by id
     async def get_by_ids(self, ids: List[str], fields=None) -> Union[List[dict], None]:
-        """Get doc_chunks data by id"""
+        """Get doc_chunks data by id with one IN query, results are aligned with ids"""
+        if not ids:
+            return []
         sql = SQL_TEMPLATES["get_by_ids_" + self.namespace].format(
             ids=",".join([f"'{id}'" for id in ids])
         )
@@ -216,7 +218,9 @@ class PGKVStorage(BaseKVStorage):
                 dict_res[row["mode"]][row["id"]] = row
             res = [{k: v} for k, v in dict_res.items()]
         else:
-            res = await self.db.query(sql, params, multirows=True)
+            rows = await self.db.query(sql, params, multirows=True) or []
+            rows_by_id = {row["id"]: row for row in rows}
+            return [rows_by_id.get(id) for id in ids]
         if res:
             return res
         else:
@@ -115,18 +115,16 @@ class TiDBKVStorage(BaseKVStorage):
 
     # Query by id
     async def get_by_ids(self, ids: list[str], fields=None) -> Union[list[dict], None]:
-        """根据 id 获取 doc_chunks 数据"""
+        """根据 id 获取 doc_chunks 数据, 一次 IN 查询, 结果与 ids 顺序对齐"""
+        if not ids:
+            return []
         SQL = SQL_TEMPLATES["get_by_ids_" + self.namespace].format(
             ids=",".join([f"'{id}'" for id in ids])
         )
         # print("get_by_ids:"+SQL)
-        res = await self.db.query(SQL, multirows=True)
-        if res:
-            data = res  # [{"data":i} for i in res]
-            # print(data)
-            return data
-        else:
-            return None
+        res = await self.db.query(SQL, multirows=True) or []
+        rows_by_id = {row["id"]: row for row in res}
+        return [rows_by_id.get(id) for id in ids]
 
     async def filter_keys(self, keys: list[str]) -> set[str]:
         """过滤掉重复内容"""
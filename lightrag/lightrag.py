@@ -1,18 +1,24 @@
 import asyncio
 import os
+import time
 from tqdm.asyncio import tqdm as tqdm_async
-from dataclasses import asdict, dataclass, field
+from dataclasses import asdict, dataclass, field, replace
 from datetime import datetime
 from functools import partial
 from typing import Type, cast, Dict
 
 from .llm import (
+    aclose_provider_clients,
     gpt_4o_mini_complete,
     openai_embedding,
 )
 from .operate import (
     chunking_by_token_size,
-    extract_entities,
+    extract_chunk_records,
+    merge_chunk_records,
+    mark_chunks_merged,
+    replay_per_document_merges,
+    compact_summaries,
     # local_query,global_query,hybrid_query,
     kg_query,
     naive_query,
@@ -20,10 +26,19 @@ from .operate import (
 )
 
 from .utils import (
+    EmbeddingCache,
     EmbeddingFunc,
+    MinHashIndex,
+    SingleFlight,
+    compute_args_hash,
     compute_mdhash_id,
+    PRIORITY_QUERY,
+    admission_priority,
     limit_async_func_call,
+    memoize_query_embeddings,
+    query_embedding_scope,
     convert_response_to_json,
+    get_tokenizer_service,
     logger,
     set_logger,
 )
@@ -34,13 +49,16 @@ from .base import (
     StorageNameSpace,
     QueryParam,
     DocStatus,
+    ChunkStatus,
 )
 
 from .storage import (
     JsonKVStorage,
+    JsonLLMCacheStorage,
     NanoVectorDBStorage,
     NetworkXStorage,
     JsonDocStatusStorage,
+    JsonChunkStatusStorage,
 )
 
 from .prompt import GRAPH_FIELD_SEP
@@ -132,6 +150,23 @@ class LightRAG:
             "use_llm_check": False,
         }
     )
+    # Default not to detect near-duplicate chunks before entity extraction
+    chunk_dedup_config: dict = field(
+        default_factory=lambda: {
+            "enabled": False,
+            "similarity_threshold": 0.9,
+            "num_perm": 128,
+        }
+    )
+    # Default not to persist embeddings, when enabled vectors are stored in
+    # working_dir keyed by (model, md5(text)) and reused by every upsert;
+    # model names the embedding model and is required when enabled
+    embedding_disk_cache_config: dict = field(
+        default_factory=lambda: {
+            "enabled": False,
+            "model": None,
+        }
+    )
     kv_storage: str = field(default="JsonKVStorage")
     vector_storage: str = field(default="NanoVectorDBStorage")
     graph_storage: str = field(default="NetworkXStorage")
@@ -143,10 +178,17 @@ class LightRAG:
     chunk_token_size: int = 1200
     chunk_overlap_token_size: int = 100
     tiktoken_model_name: str = "gpt-4o-mini"
+    # chunking_by_structure splits on paragraphs and sentences and records character offsets
+    chunking_func: callable = chunking_by_token_size
+    # threads tokenizing off the event loop, see TokenizerService
+    tokenizer_max_workers: int = 4
 
     # entity extraction
     entity_extract_max_gleaning: int = 1
     entity_summary_to_max_tokens: int = 500
+    # summarize over-budget descriptions in a background compaction instead of during merge,
+    # drain it with compact_summaries / acompact_summaries
+    defer_entity_summary: bool = False
 
     # node embedding
     node_embedding_algorithm: str = "node2vec"
@@ -165,6 +207,17 @@ class LightRAG:
     embedding_func: EmbeddingFunc = field(default_factory=lambda: openai_embedding)
     embedding_batch_num: int = 32
     embedding_func_max_async: int = 16
+    # Seconds concurrent embedding calls wait to be sent as one request of up
+    # to embedding_batch_num texts, 0 disables micro-batching
+    embedding_batch_window: float = 0.0
+    # Query embeddings kept in a process-wide LRU, 0 disables it
+    query_embedding_cache_size: int = 1024
+
+    # insert pipeline, documents in flight per stage and queue size between stages
+    max_parallel_insert: int = 4
+    insert_queue_size: int = 8
+    # merge the extraction results of a whole insert batch into the graph at once
+    batch_graph_merge: bool = False
 
     # LLM
     llm_model_func: callable = gpt_4o_mini_complete  # hf_model_complete#
@@ -177,6 +230,15 @@ class LightRAG:
     vector_db_storage_cls_kwargs: dict = field(default_factory=dict)
 
     enable_llm_cache: bool = True
+    # Budget of the LLM response cache, 0 disables a limit; eviction_policy is "lru" or "lfu"
+    llm_cache_config: dict = field(
+        default_factory=lambda: {
+            "max_entries": 10000,
+            "max_bytes": 0,
+            "eviction_policy": "lru",
+            "ttl_seconds": None,
+        }
+    )
     # Sometimes there are some reason the LLM failed at Extracting Entities, and we want to continue without LLM cost, we can use this flag
     enable_llm_cache_for_entity_extract: bool = True
 
@@ -186,6 +248,8 @@ class LightRAG:
 
     # Add new field for document status storage type
     doc_status_storage: str = field(default="JsonDocStatusStorage")
+    # Per-chunk extraction checkpoints, lets failed documents resume
+    chunk_status_storage: str = field(default="JsonChunkStatusStorage")
 
     def __post_init__(self):
         log_file = os.path.join("lightrag.log")
@@ -213,15 +277,47 @@ class LightRAG:
             logger.info(f"Creating working directory {self.working_dir}")
             os.makedirs(self.working_dir)
 
-        self.llm_response_cache = self.key_string_value_json_storage_cls(
+        # The JSON kv storage gets a bounded cache addressing entries one by one
+        llm_cache_storage_cls = (
+            JsonLLMCacheStorage
+            if self.key_string_value_json_storage_cls is JsonKVStorage
+            else self.key_string_value_json_storage_cls
+        )
+        self.llm_response_cache = llm_cache_storage_cls(
             namespace="llm_response_cache",
             global_config=asdict(self),
             embedding_func=None,
         )
 
+        self._embedding_cache = None
+        if self.embedding_disk_cache_config.get("enabled"):
+            model = self.embedding_disk_cache_config.get("model")
+            if not model:
+                # A function name would let different models share one cache
+                raise ValueError(
+                    "embedding_disk_cache_config['model'] must name the embedding "
+                    "model when the embedding disk cache is enabled"
+                )
+            self._embedding_cache = EmbeddingCache(
+                self.working_dir, model, self.embedding_func.embedding_dim
+            )
+            self.embedding_func = replace(
+                self.embedding_func, cache=self._embedding_cache
+            )
+
+        if self.embedding_batch_window > 0:
+            self.embedding_func = replace(
+                self.embedding_func,
+                batch_window=self.embedding_batch_window,
+                max_batch_size=self.embedding_batch_num,
+            )
+
         self.embedding_func = limit_async_func_call(self.embedding_func_max_async)(
             self.embedding_func
         )
+        self.embedding_func = memoize_query_embeddings(self.query_embedding_cache_size)(
+            self.embedding_func
+        )
 
         ####
         # add embedding func by walter
@@ -285,11 +381,43 @@ class LightRAG:
             global_config=asdict(self),
             embedding_func=None,
         )
+        self.chunk_status = self._get_storage_class()[self.chunk_status_storage](
+            namespace="chunk_status",
+            global_config=asdict(self),
+            embedding_func=None,
+        )
+
+        # Identical in-flight extraction prompts and queries share one LLM call
+        self._llm_flights = SingleFlight()
+
+        # Entities and relations waiting for summary compaction, persisted in
+        # the summary_pending namespace so a restart still compacts them
+        self.summary_pending = self.key_string_value_json_storage_cls(
+            namespace="summary_pending",
+            global_config=asdict(self),
+            embedding_func=None,
+        )
+        self._pending_summaries = set()
+        self._persisted_summaries = set()
+        self._pending_summaries_loaded = False
+        self._compaction_task = None
+
+        # Near-duplicate chunk index, filled from chunk_status on first insert
+        self._chunk_dedup = None
+        if self.chunk_dedup_config and self.chunk_dedup_config.get("enabled"):
+            self._chunk_dedup = MinHashIndex(
+                similarity_threshold=self.chunk_dedup_config.get(
+                    "similarity_threshold", 0.9
+                ),
+                num_perm=self.chunk_dedup_config.get("num_perm", 128),
+            )
+        self._chunk_dedup_loaded = False
 
     def _get_storage_class(self) -> dict:
         return {
             # kv storage
             "JsonKVStorage": JsonKVStorage,
+            "JsonLLMCacheStorage": JsonLLMCacheStorage,
             "OracleKVStorage": OracleKVStorage,
             "MongoKVStorage": MongoKVStorage,
             "TiDBKVStorage": TiDBKVStorage,
@@ -312,6 +440,7 @@ class LightRAG:
             "GremlinStorage": GremlinStorage,
             # "ArangoDBStorage": ArangoDBStorage
             "JsonDocStatusStorage": JsonDocStatusStorage,
+            "JsonChunkStatusStorage": JsonChunkStatusStorage,
         }
 
     def insert(self, string_or_strings, split_by_character=None):
@@ -360,103 +489,461 @@ class LightRAG:
         batch_size = self.addon_params.get("insert_batch_size", 10)
         for i in range(0, len(new_docs), batch_size):
             batch_docs = dict(list(new_docs.items())[i : i + batch_size])
+            await self._process_batch(
+                batch_docs,
+                split_by_character,
+                desc=f"Processing batch {i // batch_size + 1}",
+            )
+            if self.defer_entity_summary:
+                self._schedule_summary_compaction()
 
-            for doc_id, doc in tqdm_async(
-                batch_docs.items(), desc=f"Processing batch {i // batch_size + 1}"
-            ):
-                try:
-                    # Update status to processing
-                    doc_status = {
-                        "content_summary": doc["content_summary"],
-                        "content_length": doc["content_length"],
-                        "status": DocStatus.PROCESSING,
-                        "created_at": doc["created_at"],
-                        "updated_at": datetime.now().isoformat(),
-                    }
-                    await self.doc_status.upsert({doc_id: doc_status})
+    def _schedule_summary_compaction(self):
+        """Start a compaction in the background unless one is already running"""
+        if not self._pending_summaries:
+            return
+        if self._compaction_task is None or self._compaction_task.done():
+            self._compaction_task = asyncio.ensure_future(self.acompact_summaries())
 
-                    # Generate chunks from document
-                    chunks = {
-                        compute_mdhash_id(dp["content"], prefix="chunk-"): {
-                            **dp,
-                            "full_doc_id": doc_id,
-                        }
-                        for dp in chunking_by_token_size(
-                            doc["content"],
-                            split_by_character=split_by_character,
-                            overlap_token_size=self.chunk_overlap_token_size,
-                            max_token_size=self.chunk_token_size,
-                            tiktoken_model=self.tiktoken_model_name,
-                        )
-                    }
+    def compact_summaries(self):
+        loop = always_get_an_event_loop()
+        return loop.run_until_complete(self.acompact_summaries())
+
+    @staticmethod
+    def _summary_key(name) -> str:
+        return name if isinstance(name, str) else GRAPH_FIELD_SEP.join(name)
+
+    async def _load_pending_summaries(self):
+        """Queue the names left pending by a previous run, once"""
+        if self._pending_summaries_loaded:
+            return
+        self._pending_summaries_loaded = True
+        keys = await self.summary_pending.all_keys()
+        loaded = set()
+        for record in await self.summary_pending.get_by_ids(keys):
+            if not record:
+                continue
+            if "entity" in record:
+                loaded.add(record["entity"])
+            else:
+                loaded.add((record["src_id"], record["tgt_id"]))
+        self._pending_summaries |= loaded
+        self._persisted_summaries |= loaded
+        if loaded:
+            logger.info(f"Loaded {len(loaded)} descriptions pending summary compaction")
+
+    async def _save_pending_summaries(self, remove_done: bool = False):
+        """Persist newly queued names, and with remove_done drop the summarized ones
+
+        Names are only removed after a compaction finished with them, so a
+        crash mid-compaction leaves them queued for the next run.
+        """
+        current = set(self._pending_summaries)
+        added = current - self._persisted_summaries
+        removed = self._persisted_summaries - current if remove_done else set()
+        if added:
+            await self.summary_pending.upsert(
+                {
+                    self._summary_key(name): {"entity": name}
+                    if isinstance(name, str)
+                    else {"src_id": name[0], "tgt_id": name[1]}
+                    for name in added
+                }
+            )
+        if removed:
+            await self.summary_pending.delete(
+                [self._summary_key(name) for name in removed]
+            )
+        if added or removed:
+            self._persisted_summaries = (self._persisted_summaries | added) - removed
+            await self.summary_pending.index_done_callback()
+
+    async def acompact_summaries(self) -> int:
+        """Summarize entity and relation descriptions deferred by defer_entity_summary
+
+        Returns:
+            Number of descriptions replaced by their summary
+        """
+        await self._load_pending_summaries()
+        summarized = await compact_summaries(
+            self._pending_summaries,
+            self.chunk_entity_relation_graph,
+            self.entities_vdb,
+            self.relationships_vdb,
+            asdict(self),
+        )
+        if summarized:
+            await asyncio.gather(
+                *[
+                    cast(StorageNameSpace, storage_inst).index_done_callback()
+                    for storage_inst in [
+                        self.chunk_entity_relation_graph,
+                        self.entities_vdb,
+                        self.relationships_vdb,
+                    ]
+                ]
+            )
+        await self._save_pending_summaries(remove_done=True)
+        return summarized
+
+    async def _process_batch(self, batch_docs: dict, split_by_character, desc: str):
+        """Run a batch of documents through the staged insert pipeline
+
+        Stages are chunk -> embed -> extract -> merge -> persist, connected by
+        bounded queues so up to max_parallel_insert documents are embedded and
+        extracted at once. Merge and persist run in a single worker each, the
+        graph is only ever updated by one document at a time. With
+        batch_graph_merge the merge is deferred to the end of the batch so each
+        entity and relation is merged, summarized and embedded once.
+        """
+        global_config = asdict(self)
+        workers = max(1, self.max_parallel_insert)
+        chunk_dedup = await self._load_chunk_dedup()
+        await self._load_pending_summaries()
+        tokenizer = get_tokenizer_service(
+            self.tiktoken_model_name, self.tokenizer_max_workers
+        )
+        dedup_before = dict(chunk_dedup.stats) if chunk_dedup is not None else None
+        stats = {
+            name: {"docs": 0, "chunks": 0, "seconds": 0.0, "first": None, "last": None}
+            for name in ["chunk", "embed", "extract", "merge", "persist"]
+        }
+        # Chunk ids taken by a document of this batch, a chunk shared by two
+        # documents is only embedded, extracted and merged by the first one
+        claimed_chunks = set()
+        pbar = tqdm_async(total=len(batch_docs), desc=desc)
+
+        async def fail_doc(item: dict, e: Exception):
+            import traceback
+
+            logger.error(
+                f"Failed to process document {item['doc_id']}: {str(e)}\n{traceback.format_exc()}"
+            )
+            item["doc_status"].update(
+                {
+                    "status": DocStatus.FAILED,
+                    "error": str(e),
+                    "updated_at": datetime.now().isoformat(),
+                }
+            )
+            await self.doc_status.upsert({item["doc_id"]: item["doc_status"]})
+            pbar.update(1)
+
+        async def chunk_doc(item: dict):
+            doc_id, doc = item["doc_id"], item["doc"]
+            await self.doc_status.upsert({doc_id: item["doc_status"]})
+            # Keep the content so a failed document can be resumed
+            await self.full_docs.upsert({doc_id: {"content": doc["content"]}})
+
+            # Chunking is tokenization bound, keep it off the event loop
+            chunk_list = await tokenizer.run(
+                self.chunking_func,
+                doc["content"],
+                split_by_character=split_by_character,
+                overlap_token_size=self.chunk_overlap_token_size,
+                max_token_size=self.chunk_token_size,
+                tiktoken_model=self.tiktoken_model_name,
+            )
+            item["chunks"] = {
+                compute_mdhash_id(dp["content"], prefix="chunk-"): {
+                    **dp,
+                    "full_doc_id": doc_id,
+                }
+                for dp in chunk_list
+            }
+            item["new_chunks"] = {
+                k: v for k, v in item["chunks"].items() if k not in claimed_chunks
+            }
+            claimed_chunks.update(item["new_chunks"])
 
-                    # Update status with chunks information
-                    doc_status.update(
-                        {
-                            "chunks_count": len(chunks),
+            # Update status with chunks information
+            item["doc_status"].update(
+                {
+                    "chunks_count": len(item["chunks"]),
+                    "updated_at": datetime.now().isoformat(),
+                }
+            )
+            await self.doc_status.upsert({doc_id: item["doc_status"]})
+
+        async def embed_chunks(item: dict):
+            # Chunks with a status were embedded by an earlier run
+            chunks = item["new_chunks"]
+            new_chunk_keys = await self.chunk_status.filter_keys(list(chunks.keys()))
+            new_chunks = {k: v for k, v in chunks.items() if k in new_chunk_keys}
+            if new_chunks:
+                await self.chunks_vdb.upsert(new_chunks)
+                await self.chunk_status.upsert(
+                    {
+                        k: {
+                            "full_doc_id": item["doc_id"],
+                            "status": ChunkStatus.PENDING,
                             "updated_at": datetime.now().isoformat(),
                         }
-                    )
-                    await self.doc_status.upsert({doc_id: doc_status})
+                        for k in new_chunks
+                    }
+                )
 
-                    try:
-                        # Store chunks in vector database
-                        await self.chunks_vdb.upsert(chunks)
-
-                        # Extract and store entities and relationships
-                        maybe_new_kg = await extract_entities(
-                            chunks,
-                            knowledge_graph_inst=self.chunk_entity_relation_graph,
-                            entity_vdb=self.entities_vdb,
-                            relationships_vdb=self.relationships_vdb,
-                            llm_response_cache=self.llm_response_cache,
-                            global_config=asdict(self),
-                        )
+        async def extract_chunks(item: dict):
+            item["chunk_results"] = await extract_chunk_records(
+                item["new_chunks"],
+                global_config,
+                llm_response_cache=self.llm_response_cache,
+                chunk_status=self.chunk_status,
+                chunk_dedup=chunk_dedup,
+                llm_flights=self._llm_flights,
+            )
+
+        batch_results = {}
+        doc_results = []
 
-                        if maybe_new_kg is None:
-                            raise Exception(
-                                "Failed to extract entities and relationships"
-                            )
+        async def merge_chunks(item: dict):
+            chunk_results = item["chunk_results"]
+            if self.batch_graph_merge:
+                doc_results.append(chunk_results)
+                batch_results.update(chunk_results)
+                return
+            if chunk_results:
+                maybe_new_kg = await merge_chunk_records(
+                    chunk_results,
+                    self.chunk_entity_relation_graph,
+                    self.entities_vdb,
+                    self.relationships_vdb,
+                    global_config,
+                    pending_summaries=self._pending_summaries,
+                )
+                if maybe_new_kg is None:
+                    raise Exception("Failed to extract entities and relationships")
+                self.chunk_entity_relation_graph = maybe_new_kg
+                await mark_chunks_merged(self.chunk_status, chunk_results)
+            elif item["chunks"]:
+                logger.info(
+                    "All chunks have been merged before, skip entity extraction"
+                )
+            await self.text_chunks.upsert(item["chunks"])
 
-                        self.chunk_entity_relation_graph = maybe_new_kg
+        unflushed = []
 
-                        # Store original document and chunks
-                        await self.full_docs.upsert(
-                            {doc_id: {"content": doc["content"]}}
-                        )
-                        await self.text_chunks.upsert(chunks)
-
-                        # Update status to processed
-                        doc_status.update(
-                            {
-                                "status": DocStatus.PROCESSED,
-                                "updated_at": datetime.now().isoformat(),
-                            }
-                        )
-                        await self.doc_status.upsert({doc_id: doc_status})
+        async def flush_persisted():
+            if not unflushed:
+                return
+            await self._insert_done()
+            for done in unflushed:
+                done["doc_status"].update(
+                    {
+                        "status": DocStatus.PROCESSED,
+                        "updated_at": datetime.now().isoformat(),
+                    }
+                )
+                await self.doc_status.upsert({done["doc_id"]: done["doc_status"]})
+            pbar.update(len(unflushed))
+            unflushed.clear()
+
+        async def persist_doc(item: dict):
+            # Flush once per run of finished documents instead of per document
+            unflushed.append(item)
+            if queues["persist"].empty() and not self.batch_graph_merge:
+                await flush_persisted()
+
+        async def merge_batch():
+            if not batch_results:
+                for item in unflushed:
+                    await self.text_chunks.upsert(item["chunks"])
+                return
+            merge_stats = {"summaries": 0, "embeddings": 0}
+            try:
+                per_doc = await replay_per_document_merges(
+                    doc_results,
+                    self.chunk_entity_relation_graph,
+                    self.entities_vdb,
+                    self.relationships_vdb,
+                    global_config,
+                )
+                maybe_new_kg = await merge_chunk_records(
+                    batch_results,
+                    self.chunk_entity_relation_graph,
+                    self.entities_vdb,
+                    self.relationships_vdb,
+                    global_config,
+                    pending_summaries=self._pending_summaries,
+                    merge_stats=merge_stats,
+                )
+                if maybe_new_kg is None:
+                    raise Exception("Failed to extract entities and relationships")
+                self.chunk_entity_relation_graph = maybe_new_kg
+                await mark_chunks_merged(self.chunk_status, batch_results)
+                for item in unflushed:
+                    await self.text_chunks.upsert(item["chunks"])
+            except Exception as e:
+                for item in unflushed:
+                    await fail_doc(item, e)
+                unflushed.clear()
+                return
 
+            for kind, label in (
+                ("summaries", "summary LLM calls"),
+                ("embeddings", "vector embeddings"),
+            ):
+                logger.info(
+                    f"Batch merge of {len(unflushed)} docs: {merge_stats[kind]} "
+                    f"{label}, {per_doc[kind]} when merging per document "
+                    f"(replayed), saved {per_doc[kind] - merge_stats[kind]}"
+                )
+
+        stages = [
+            ("chunk", chunk_doc, workers),
+            ("embed", embed_chunks, workers),
+            ("extract", extract_chunks, workers),
+            ("merge", merge_chunks, 1),
+            ("persist", persist_doc, 1),
+        ]
+        queues = {
+            name: asyncio.Queue(maxsize=max(1, self.insert_queue_size))
+            for name, _, _ in stages
+        }
+
+        async def run_stage(index: int):
+            name, handler, n_workers = stages[index]
+            in_q = queues[name]
+            out_q = queues[stages[index + 1][0]] if index + 1 < len(stages) else None
+
+            async def worker():
+                while True:
+                    item = await in_q.get()
+                    if item is None:
+                        return
+                    start = time.perf_counter()
+                    if stats[name]["first"] is None:
+                        stats[name]["first"] = start
+                    try:
+                        await handler(item)
                     except Exception as e:
-                        # Mark as failed if any step fails
-                        doc_status.update(
-                            {
-                                "status": DocStatus.FAILED,
-                                "error": str(e),
-                                "updated_at": datetime.now().isoformat(),
-                            }
-                        )
-                        await self.doc_status.upsert({doc_id: doc_status})
-                        raise e
+                        await fail_doc(item, e)
+                        continue
+                    finally:
+                        stats[name]["last"] = time.perf_counter()
+                        stats[name]["seconds"] += stats[name]["last"] - start
+                    stats[name]["docs"] += 1
+                    stats[name]["chunks"] += len(item.get("chunks", {}))
+                    if out_q is not None:
+                        await out_q.put(item)
+
+            await gather_or_cancel(*[worker() for _ in range(n_workers)])
+            if out_q is not None:
+                for _ in range(stages[index + 1][2]):
+                    await out_q.put(None)
+
+        async def gather_or_cancel(*coros):
+            # Don't leave sibling tasks running when one of them raises
+            tasks = [asyncio.ensure_future(c) for c in coros]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+
+        async def feed():
+            for doc_id, doc in batch_docs.items():
+                doc_status = {
+                    "content_summary": doc["content_summary"],
+                    "content_length": doc["content_length"],
+                    "status": DocStatus.PROCESSING,
+                    "created_at": doc["created_at"],
+                    "updated_at": datetime.now().isoformat(),
+                }
+                await queues["chunk"].put(
+                    {"doc_id": doc_id, "doc": doc, "doc_status": doc_status}
+                )
+            for _ in range(stages[0][2]):
+                await queues["chunk"].put(None)
+
+        batch_start = time.perf_counter()
+        try:
+            await gather_or_cancel(
+                feed(), *[run_stage(index) for index in range(len(stages))]
+            )
+            if self.batch_graph_merge:
+                await merge_batch()
+            await flush_persisted()
+        finally:
+            # Failed documents may still hold checkpoints worth keeping
+            await self._insert_done()
+            pbar.close()
+
+        elapsed = time.perf_counter() - batch_start
+        for name, stage_stats in stats.items():
+            # Throughput over the stage's wall time, from its first item to its
+            # last; busy time is summed over the stage's workers
+            wall = (
+                stage_stats["last"] - stage_stats["first"]
+                if stage_stats["first"] is not None
+                else 0.0
+            )
+            logger.info(
+                f"Insert stage {name}: {stage_stats['docs']} docs, "
+                f"{stage_stats['chunks']} chunks, {stage_stats['seconds']:.2f}s busy, "
+                f"{wall:.2f}s wall, {stage_stats['docs'] / wall if wall else 0:.2f} docs/s"
+            )
+        logger.info(f"Inserted batch of {len(batch_docs)} docs in {elapsed:.2f}s")
+        for name, admission in self.admission_stats().items():
+            logger.info(
+                f"{name} admission: {admission['admitted']} calls, "
+                f"avg wait {admission['avg_wait']:.3f}s, max wait {admission['max_wait']:.3f}s"
+            )
+        logger.info(
+            f"Identical in-flight LLM calls coalesced: {self._llm_flights.coalesced}"
+        )
+        if chunk_dedup is not None:
+            logger.info(
+                f"Near-duplicate chunks: {chunk_dedup.stats['duplicates'] - dedup_before['duplicates']} "
+                f"reused their twin's extraction, "
+                f"{chunk_dedup.stats['llm_calls_avoided'] - dedup_before['llm_calls_avoided']} "
+                f"LLM calls avoided"
+            )
 
-                except Exception as e:
-                    import traceback
+    async def _load_chunk_dedup(self) -> MinHashIndex:
+        """Return the near-duplicate index, adding signatures saved in chunk_status once"""
+        if self._chunk_dedup is None or self._chunk_dedup_loaded:
+            return self._chunk_dedup
+        self._chunk_dedup_loaded = True
+        keys = await self.chunk_status.all_keys()
+        for key, status in zip(keys, await self.chunk_status.get_by_ids(keys)):
+            if status and status.get("minhash"):
+                self._chunk_dedup.add(key, status["minhash"])
+        logger.info(
+            f"Loaded {len(self._chunk_dedup)} chunk signatures for deduplication"
+        )
+        return self._chunk_dedup
 
-                    error_msg = f"Failed to process document {doc_id}: {str(e)}\n{traceback.format_exc()}"
-                    logger.error(error_msg)
-                    continue
+    def resume_failed(self, split_by_character=None):
+        loop = always_get_an_event_loop()
+        return loop.run_until_complete(self.aresume_failed(split_by_character))
+
+    async def aresume_failed(self, split_by_character=None):
+        """Run failed documents through the insert pipeline again
+
+        Chunks already embedded, extracted or merged by the failed run are not
+        processed again, see extract_chunk_records.
+
+        Args:
+            split_by_character: if split_by_character is not None, split the string by character
+        """
+        failed_docs = await self.doc_status.get_failed_docs()
+        if not failed_docs:
+            logger.info("No failed documents to resume")
+            return
 
-                finally:
-                    # Ensure all indexes are updated after each document
-                    await self._insert_done()
+        doc_ids = list(failed_docs.keys())
+        docs = await self.full_docs.get_by_ids(doc_ids)
+        contents = []
+        for doc_id, doc in zip(doc_ids, docs):
+            if doc is None:
+                logger.warning(f"Content of failed document {doc_id} not found")
+                continue
+            contents.append(doc["content"])
+
+        logger.info(f"Resuming {len(contents)} failed documents")
+        if contents:
+            await self.ainsert(contents, split_by_character)
 
     async def _insert_done(self):
         tasks = []
@@ -468,11 +955,40 @@ class LightRAG:
             self.relationships_vdb,
             self.chunks_vdb,
             self.chunk_entity_relation_graph,
+            self.chunk_status,
         ]:
             if storage_inst is None:
                 continue
             tasks.append(cast(StorageNameSpace, storage_inst).index_done_callback())
         await asyncio.gather(*tasks)
+        await self._save_pending_summaries()
+        if self._embedding_cache is not None:
+            stats = self._embedding_cache.stats()
+            logger.info(
+                f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+                f"({stats['hit_rate']:.1%} hit rate), {stats['bytes_saved']} bytes "
+                f"not sent, {stats['entries']} entries"
+            )
+
+    def admission_stats(self) -> dict:
+        """Queue depth and wait times of the LLM and embedding call limits"""
+        return {
+            "llm": self.llm_model_func.admission.stats(),
+            "embedding": self.embedding_func.admission.stats(),
+        }
+
+    def close(self):
+        """Synchronous version of aclose"""
+        loop = always_get_an_event_loop()
+        return loop.run_until_complete(self.aclose())
+
+    async def aclose(self):
+        """Close the shared LLM/embedding provider clients on shutdown.
+
+        Provider clients and local HF models are shared process-wide, a later
+        call simply opens or loads new ones.
+        """
+        await aclose_provider_clients()
 
     def insert_custom_kg(self, custom_kg: dict):
         loop = always_get_an_event_loop()
@@ -481,6 +997,9 @@ class LightRAG:
     async def ainsert_custom_kg(self, custom_kg: dict):
         update_storage = False
         try:
+            tokenizer = get_tokenizer_service(
+                self.tiktoken_model_name, self.tokenizer_max_workers
+            )
             # Insert chunks into vector storage
             all_chunks_data = {}
             chunk_to_source_map = {}
@@ -489,7 +1008,11 @@ class LightRAG:
                 source_id = chunk_data["source_id"]
                 chunk_id = compute_mdhash_id(chunk_content.strip(), prefix="chunk-")
 
-                chunk_entry = {"content": chunk_content.strip(), "source_id": source_id}
+                chunk_entry = {
+                    "content": chunk_content.strip(),
+                    "tokens": len(await tokenizer.encode(chunk_content.strip())),
+                    "source_id": source_id,
+                }
                 all_chunks_data[chunk_id] = chunk_entry
                 chunk_to_source_map[source_id] = chunk_id
                 update_storage = True
@@ -519,6 +1042,7 @@ class LightRAG:
                 node_data = {
                     "entity_type": entity_type,
                     "description": description,
+                    "description_tokens": len(await tokenizer.encode(description)),
                     "source_id": source_id,
                 }
                 # Insert node data into the knowledge graph
@@ -568,6 +1092,7 @@ class LightRAG:
                     edge_data={
                         "weight": weight,
                         "description": description,
+                        "description_tokens": len(await tokenizer.encode(description)),
                         "keywords": keywords,
                         "source_id": source_id,
                     },
@@ -615,6 +1140,23 @@ class LightRAG:
         return loop.run_until_complete(self.aquery(query, param))
 
     async def aquery(self, query: str, param: QueryParam = QueryParam()):
+        # Embed each distinct string needed by the query once, and let its
+        # LLM/embedding calls overtake queued ingestion work
+        with query_embedding_scope(), admission_priority(PRIORITY_QUERY):
+            if param.stream:
+                response = await self._run_query(query, param)
+            else:
+                # The same question asked concurrently is answered once
+                response = await self._llm_flights.do(
+                    ("query", compute_args_hash(param.mode, query), repr(param)),
+                    self._run_query,
+                    query,
+                    param,
+                )
+        await self._query_done()
+        return response
+
+    async def _run_query(self, query: str, param: QueryParam):
         if param.mode in ["local", "global", "hybrid"]:
             response = await kg_query(
                 query,
@@ -670,7 +1212,6 @@ class LightRAG:
             )
         else:
             raise ValueError(f"Unknown mode {param.mode}")
-        await self._query_done()
         return response
 
     async def _query_done(self):
@@ -757,35 +1298,26 @@ class LightRAG:
             chunk_ids = list(chunks.keys())
             logger.debug(f"Found {len(chunk_ids)} chunks to delete")
 
-            # 3. Before deleting, check the related entities and relationships for these chunks
-            for chunk_id in chunk_ids:
-                # Check entities
-                entities = [
-                    dp
-                    for dp in self.entities_vdb.client_storage["data"]
-                    if dp.get("source_id") == chunk_id
-                ]
-                logger.debug(f"Chunk {chunk_id} has {len(entities)} related entities")
-
-                # Check relationships
-                relations = [
-                    dp
-                    for dp in self.relationships_vdb.client_storage["data"]
-                    if dp.get("source_id") == chunk_id
-                ]
-                logger.debug(f"Chunk {chunk_id} has {len(relations)} related relations")
-
-            # Continue with the original deletion process...
+            # 3. Look up the entities and relationships extracted from these chunks
+            graph = self.chunk_entity_relation_graph
+            affected_nodes, affected_edges = await graph.get_chunks_graph_elements(
+                chunk_ids
+            )
+            affected_nodes, affected_edges = list(affected_nodes), list(affected_edges)
+            logger.debug(
+                f"Chunks reference {len(affected_nodes)} entities and {len(affected_edges)} relations"
+            )
 
             # 4. Delete chunks from vector database
             if chunk_ids:
                 await self.chunks_vdb.delete(chunk_ids)
                 await self.text_chunks.delete(chunk_ids)
+                await self.chunk_status.delete(chunk_ids)
+                if self._chunk_dedup is not None:
+                    self._chunk_dedup.remove(chunk_ids)
 
-            # 5. Find and process entities and relationships that have these chunks as source
-            # Get all nodes in the graph
-            nodes = self.chunk_entity_relation_graph._graph.nodes(data=True)
-            edges = self.chunk_entity_relation_graph._graph.edges(data=True)
+            # 5. Drop the deleted chunks from the sources of the affected elements
+            removed_chunks = set(chunk_ids)
 
             # Track which entities and relationships need to be deleted or updated
             entities_to_delete = set()
@@ -794,40 +1326,36 @@ class LightRAG:
             relationships_to_update = {}  # (src, tgt) -> new_source_id
 
             # Process entities
-            for node, data in nodes:
-                if "source_id" in data:
-                    # Split source_id using GRAPH_FIELD_SEP
-                    sources = set(data["source_id"].split(GRAPH_FIELD_SEP))
-                    sources.difference_update(chunk_ids)
-                    if not sources:
-                        entities_to_delete.add(node)
-                        logger.debug(
-                            f"Entity {node} marked for deletion - no remaining sources"
-                        )
-                    else:
-                        new_source_id = GRAPH_FIELD_SEP.join(sources)
-                        entities_to_update[node] = new_source_id
-                        logger.debug(
-                            f"Entity {node} will be updated with new source_id: {new_source_id}"
-                        )
+            node_sources = await graph.get_nodes_chunk_ids(affected_nodes)
+            for node, sources in zip(affected_nodes, node_sources):
+                sources = [c_id for c_id in sources if c_id not in removed_chunks]
+                if not sources:
+                    entities_to_delete.add(node)
+                    logger.debug(
+                        f"Entity {node} marked for deletion - no remaining sources"
+                    )
+                else:
+                    new_source_id = GRAPH_FIELD_SEP.join(sources)
+                    entities_to_update[node] = new_source_id
+                    logger.debug(
+                        f"Entity {node} will be updated with new source_id: {new_source_id}"
+                    )
 
             # Process relationships
-            for src, tgt, data in edges:
-                if "source_id" in data:
-                    # Split source_id using GRAPH_FIELD_SEP
-                    sources = set(data["source_id"].split(GRAPH_FIELD_SEP))
-                    sources.difference_update(chunk_ids)
-                    if not sources:
-                        relationships_to_delete.add((src, tgt))
-                        logger.debug(
-                            f"Relationship {src}-{tgt} marked for deletion - no remaining sources"
-                        )
-                    else:
-                        new_source_id = GRAPH_FIELD_SEP.join(sources)
-                        relationships_to_update[(src, tgt)] = new_source_id
-                        logger.debug(
-                            f"Relationship {src}-{tgt} will be updated with new source_id: {new_source_id}"
-                        )
+            edge_sources = await graph.get_edges_chunk_ids(affected_edges)
+            for (src, tgt), sources in zip(affected_edges, edge_sources):
+                sources = [c_id for c_id in sources if c_id not in removed_chunks]
+                if not sources:
+                    relationships_to_delete.add((src, tgt))
+                    logger.debug(
+                        f"Relationship {src}-{tgt} marked for deletion - no remaining sources"
+                    )
+                else:
+                    new_source_id = GRAPH_FIELD_SEP.join(sources)
+                    relationships_to_update[(src, tgt)] = new_source_id
+                    logger.debug(
+                        f"Relationship {src}-{tgt} will be updated with new source_id: {new_source_id}"
+                    )
 
             # Delete entities
             if entities_to_delete:
@@ -839,9 +1367,9 @@ class LightRAG:
 
             # Update entities
             for entity, new_source_id in entities_to_update.items():
-                node_data = self.chunk_entity_relation_graph._graph.nodes[entity]
+                node_data = await graph.get_node(entity)
                 node_data["source_id"] = new_source_id
-                await self.chunk_entity_relation_graph.upsert_node(entity, node_data)
+                await graph.upsert_node(entity, node_data)
                 logger.debug(
                     f"Updated entity {entity} with new source_id: {new_source_id}"
                 )
@@ -862,7 +1390,10 @@ class LightRAG:
 
             # Update relationships
             for (src, tgt), new_source_id in relationships_to_update.items():
-                edge_data = self.chunk_entity_relation_graph._graph.edges[src, tgt]
+                edge_data = await graph.get_edge(src, tgt)
+                if edge_data is None:
+                    # Removed together with one of its deleted entities
+                    continue
                 edge_data["source_id"] = new_source_id
                 await self.chunk_entity_relation_graph.upsert_edge(src, tgt, edge_data)
                 logger.debug(
@@ -896,30 +1427,18 @@ class LightRAG:
                     logger.error(f"Found {len(remaining_chunks)} remaining chunks")
 
                 # Verify entities and relationships
-                for chunk_id in chunk_ids:
-                    # Check entities
-                    entities_with_chunk = [
-                        dp
-                        for dp in self.entities_vdb.client_storage["data"]
-                        if chunk_id
-                        in (dp.get("source_id") or "").split(GRAPH_FIELD_SEP)
-                    ]
-                    if entities_with_chunk:
-                        logger.error(
-                            f"Found {len(entities_with_chunk)} entities still referencing chunk {chunk_id}"
-                        )
-
-                    # Check relationships
-                    relations_with_chunk = [
-                        dp
-                        for dp in self.relationships_vdb.client_storage["data"]
-                        if chunk_id
-                        in (dp.get("source_id") or "").split(GRAPH_FIELD_SEP)
-                    ]
-                    if relations_with_chunk:
-                        logger.error(
-                            f"Found {len(relations_with_chunk)} relations still referencing chunk {chunk_id}"
-                        )
+                (
+                    entities_with_chunk,
+                    relations_with_chunk,
+                ) = await graph.get_chunks_graph_elements(chunk_ids)
+                if entities_with_chunk:
+                    logger.error(
+                        f"Found {len(entities_with_chunk)} entities still referencing deleted chunks"
+                    )
+                if relations_with_chunk:
+                    logger.error(
+                        f"Found {len(relations_with_chunk)} relations still referencing deleted chunks"
+                    )
 
             await verify_deletion()
 
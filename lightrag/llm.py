@@ -1,13 +1,18 @@
+import asyncio
 import base64
 import copy
 import json
 import os
 import re
 import struct
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from typing import List, Dict, Callable, Any, Union, Optional
 import aioboto3
 import aiohttp
+import httpx
 import numpy as np
 import ollama
 import torch
@@ -18,6 +23,7 @@ from openai import (
     RateLimitError,
     APITimeoutError,
     AsyncAzureOpenAI,
+    DefaultAsyncHttpxClient,
 )
 from pydantic import BaseModel, Field
 from tenacity import (
@@ -30,6 +36,7 @@ from transformers import AutoTokenizer, AutoModelForCausalLM
 from datetime import datetime
 
 from .utils import (
+    TokenBucketLimiter,
     wrap_embedding_func_with_attrs,
     locate_json_string_body_from_string,
     safe_unicode_decode,
@@ -47,6 +54,193 @@ load_dotenv()
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+# Connection pool limits for the shared provider clients
+CLIENT_MAX_CONNECTIONS = 100
+CLIENT_MAX_KEEPALIVE_CONNECTIONS = 20
+CLIENT_KEEPALIVE_EXPIRY = 30.0
+
+# Long-lived provider clients keyed by (provider, base_url, api_key, options,
+# event loop), so calls reuse pooled keep-alive connections instead of paying
+# a TCP/TLS handshake each time. Async clients are bound to the loop that
+# created them, hence the loop in the key.
+_provider_clients: dict[tuple, Any] = {}
+
+
+def _get_client(provider: str, base_url, api_key, factory: Callable, **options):
+    loop = asyncio.get_running_loop()
+    key = (provider, base_url, api_key, repr(sorted(options.items())), loop)
+    client = _provider_clients.get(key)
+    if client is None:
+        # Clients of closed loops can't be used or closed any more, drop them
+        for stale in [k for k in _provider_clients if k[-1].is_closed()]:
+            del _provider_clients[stale]
+        client = _provider_clients[key] = factory()
+        logger.debug(f"Created shared {provider} client for {base_url or 'default'}")
+    return client
+
+
+# Client-side RPM/TPM limiters keyed by (provider, base_url, api_key), shared
+# by the completion and embedding calls of a key like the provider quota is.
+# They are not bound to an event loop, unlike the clients.
+_rate_limiters: dict[tuple, TokenBucketLimiter] = {}
+
+
+def _rate_limit_key(provider: str, base_url: str, api_key: str) -> tuple:
+    # Calls that leave the key to the env share the limiter of the explicit key
+    if provider == "openai":
+        api_key = api_key or os.getenv("OPENAI_API_KEY")
+    return (provider, base_url, api_key)
+
+
+def configure_rate_limit(
+    provider: str = "openai",
+    base_url: str = None,
+    api_key: str = None,
+    rpm: int = None,
+    tpm: int = None,
+) -> TokenBucketLimiter:
+    """Set the requests/tokens per minute quota of a provider endpoint and key
+
+    An existing limiter is updated in place, clients already created keep
+    feeding their response headers to it.
+    """
+    key = _rate_limit_key(provider, base_url, api_key)
+    limiter = _rate_limiters.get(key)
+    if limiter is None:
+        limiter = _rate_limiters[key] = TokenBucketLimiter(rpm=rpm, tpm=tpm)
+    else:
+        limiter.set_limits(rpm=rpm, tpm=tpm)
+    return limiter
+
+
+def get_rate_limiter(
+    provider: str, base_url: str = None, api_key: str = None
+) -> TokenBucketLimiter:
+    """Limiter of a provider endpoint and key.
+
+    Limits default to OPENAI_RPM_LIMIT / OPENAI_TPM_LIMIT from the env, otherwise
+    they are learned from the x-ratelimit-* headers of the first responses.
+    """
+    limiter = _rate_limiters.get(_rate_limit_key(provider, base_url, api_key))
+    if limiter is None:
+        rpm = os.getenv("OPENAI_RPM_LIMIT")
+        tpm = os.getenv("OPENAI_TPM_LIMIT")
+        limiter = configure_rate_limit(
+            provider,
+            base_url,
+            api_key,
+            rpm=int(rpm) if rpm else None,
+            tpm=int(tpm) if tpm else None,
+        )
+    return limiter
+
+
+def estimate_tokens(texts, max_tokens: int = None) -> int:
+    """Cheap upper-ish estimate of the tokens a request is billed for.
+
+    Roughly 4 characters per token plus the requested completion budget,
+    the limiter reconciles it with the reported usage afterwards.
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    return sum(len(text) // 4 + 4 for text in texts) + (max_tokens or 0)
+
+
+def _reconcile_usage(limiter: TokenBucketLimiter, estimated: int, response):
+    usage = getattr(response, "usage", None)
+    limiter.reconcile(estimated, getattr(usage, "total_tokens", None))
+
+
+def _httpx_client(provider: str, base_url: str, api_key: str) -> httpx.AsyncClient:
+    async def observe_rate_limits(response: httpx.Response):
+        limiter = get_rate_limiter(provider, base_url, api_key)
+        limiter.update_from_headers(response.headers, response.status_code)
+
+    return DefaultAsyncHttpxClient(
+        limits=_httpx_limits(), event_hooks={"response": [observe_rate_limits]}
+    )
+
+
+def _httpx_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=CLIENT_MAX_CONNECTIONS,
+        max_keepalive_connections=CLIENT_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_openai_client(base_url: str = None, api_key: str = None) -> AsyncOpenAI:
+    """Shared AsyncOpenAI client for an endpoint and key"""
+    return _get_client(
+        "openai",
+        base_url,
+        api_key,
+        lambda: AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=_httpx_client("openai", base_url, api_key),
+        ),
+    )
+
+
+def get_azure_openai_client(
+    base_url: str = None, api_key: str = None, api_version: str = None
+) -> AsyncAzureOpenAI:
+    """Shared AsyncAzureOpenAI client, unset arguments fall back to AZURE_OPENAI_* env"""
+    base_url = base_url or os.getenv("AZURE_OPENAI_ENDPOINT")
+    api_key = api_key or os.getenv("AZURE_OPENAI_API_KEY")
+    api_version = api_version or os.getenv("AZURE_OPENAI_API_VERSION")
+    return _get_client(
+        "azure_openai",
+        base_url,
+        api_key,
+        lambda: AsyncAzureOpenAI(
+            azure_endpoint=base_url,
+            api_key=api_key,
+            api_version=api_version,
+            http_client=DefaultAsyncHttpxClient(limits=_httpx_limits()),
+        ),
+        api_version=api_version,
+    )
+
+
+def get_ollama_client(host: str = None, **kwargs) -> ollama.AsyncClient:
+    """Shared ollama.AsyncClient for a host, kwargs are passed to the client"""
+    return _get_client(
+        "ollama",
+        host,
+        None,
+        lambda: ollama.AsyncClient(host=host, limits=_httpx_limits(), **kwargs),
+        **kwargs,
+    )
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Shared aiohttp session for providers called over plain HTTP APIs"""
+    return _get_client(
+        "aiohttp",
+        None,
+        None,
+        lambda: aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=CLIENT_MAX_CONNECTIONS,
+                keepalive_timeout=CLIENT_KEEPALIVE_EXPIRY,
+            )
+        ),
+    )
+
+
+async def aclose_provider_clients():
+    """Close the shared clients created on the running loop and the local models"""
+    loop = asyncio.get_running_loop()
+    for key in [k for k in _provider_clients if k[-1] is loop]:
+        client = _provider_clients.pop(key)
+        try:
+            await client.close()
+        except Exception as e:
+            logger.warning(f"Failed to close {key[0]} client: {e}")
+    close_local_models()
+
 
 @retry(
     stop=stop_after_attempt(3),
@@ -73,9 +267,7 @@ async def openai_complete_if_cache(
     if not model:
         model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
-    openai_async_client = (
-        AsyncOpenAI(api_key=api_key) if base_url is None else AsyncOpenAI(base_url=base_url)
-    )
+    openai_async_client = get_openai_client(base_url, api_key)
     kwargs.pop("hashing_kv", None)
     kwargs.pop("keyword_extraction", None)
     messages = []
@@ -89,6 +281,11 @@ async def openai_complete_if_cache(
     logger.debug(f"Query: {prompt}")
     logger.debug(f"System prompt: {system_prompt}")
     logger.debug("Full context:")
+    limiter = get_rate_limiter("openai", base_url, api_key)
+    estimated = estimate_tokens(
+        [str(m.get("content") or "") for m in messages], kwargs.get("max_tokens")
+    )
+    await limiter.acquire(estimated)
     if "response_format" in kwargs:
         response = await openai_async_client.beta.chat.completions.parse(
             model=model, messages=messages, **kwargs
@@ -97,6 +294,8 @@ async def openai_complete_if_cache(
         response = await openai_async_client.chat.completions.create(
             model=model, messages=messages, **kwargs
         )
+    # Streams report no usage, their estimate stands
+    _reconcile_usage(limiter, estimated, response)
 
     if hasattr(response, "__aiter__"):
 
@@ -153,18 +352,7 @@ async def azure_openai_complete_if_cache(
     api_version=None,
     **kwargs,
 ):
-    if api_key:
-        os.environ["AZURE_OPENAI_API_KEY"] = api_key
-    if base_url:
-        os.environ["AZURE_OPENAI_ENDPOINT"] = base_url
-    if api_version:
-        os.environ["AZURE_OPENAI_API_VERSION"] = api_version
-
-    openai_async_client = AsyncAzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-    )
+    openai_async_client = get_azure_openai_client(base_url, api_key, api_version)
     kwargs.pop("hashing_kv", None)
     messages = []
     if system_prompt:
@@ -275,42 +463,172 @@ async def bedrock_complete_if_cache(
     return response["output"]["message"]["content"][0]["text"]
 
 
-@lru_cache(maxsize=1)
+# Concurrent hf_model_if_cache prompts are generated together in batches of
+# up to HF_MAX_BATCH_SIZE, waiting HF_BATCH_WINDOW seconds for company
+HF_BATCH_WINDOW = float(os.getenv("HF_BATCH_WINDOW", "0.01"))
+HF_MAX_BATCH_SIZE = int(os.getenv("HF_MAX_BATCH_SIZE", "8"))
+HF_MAX_NEW_TOKENS = 512
+
+
+class HFModelRunner:
+    """A local HF causal LM kept resident on one device.
+
+    The model is loaded on first use in the runner's worker thread. generate()
+    calls are queued and served by a background task that pads the waiting
+    prompts into one batched model.generate call, run in that same thread so
+    the event loop keeps serving other requests. Prompts arriving while a
+    batch is generating form the next batch.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        device: str = "cpu",
+        batch_window: float = HF_BATCH_WINDOW,
+        max_batch_size: int = HF_MAX_BATCH_SIZE,
+    ):
+        self.model_name = model_name
+        self.device = device
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.tokenizer = None
+        self.model = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="hf-generate"
+        )
+        self._loading: Optional[asyncio.Future] = None
+        self._queue: list[tuple[str, int, asyncio.Future]] = []
+        self._worker: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.prompts = 0
+
+    def _load(self):
+        if self.model is not None:
+            return
+        logger.info(f"Loading HF model {self.model_name} on {self.device}")
+        tokenizer = AutoTokenizer.from_pretrained(
+            self.model_name, trust_remote_code=True
+        )
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        # Decoder-only models continue from the right, pad prompts on the left
+        tokenizer.padding_side = "left"
+        model = AutoModelForCausalLM.from_pretrained(
+            self.model_name, trust_remote_code=True
+        ).to(self.device)
+        model.eval()
+        self.tokenizer, self.model = tokenizer, model
+
+    async def load(self):
+        """Load the model off the event loop, concurrent callers share one load"""
+        if self.model is not None:
+            return
+        if self._loading is None:
+            self._loading = asyncio.get_running_loop().run_in_executor(
+                self._executor, self._load
+            )
+        try:
+            await asyncio.shield(self._loading)
+        except Exception:
+            # Let the next caller try again
+            self._loading = None
+            raise
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def generate(
+        self, prompt: str, max_new_tokens: int = HF_MAX_NEW_TOKENS
+    ) -> str:
+        await self.load()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((prompt, max_new_tokens, future))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._serve())
+        return await future
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        while self._queue:
+            if self.batch_window > 0 and len(self._queue) < self.max_batch_size:
+                await asyncio.sleep(self.batch_window)
+            # Only prompts with the same generation budget share a batch
+            max_new_tokens = self._queue[0][1]
+            batch = [q for q in self._queue if q[1] == max_new_tokens]
+            batch = batch[: self.max_batch_size]
+            self._queue = [q for q in self._queue if q not in batch]
+            batch = [q for q in batch if not q[2].done()]
+            if not batch:
+                continue
+            try:
+                texts = await loop.run_in_executor(
+                    self._executor,
+                    self._generate_batch,
+                    [prompt for prompt, _, _ in batch],
+                    max_new_tokens,
+                )
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, _, future), text in zip(batch, texts):
+                if not future.done():
+                    future.set_result(text)
+
+    def _generate_batch(self, prompts: list[str], max_new_tokens: int) -> list[str]:
+        inputs = self.tokenizer(
+            prompts, return_tensors="pt", padding=True, truncation=True
+        ).to(self.device)
+        with torch.no_grad():
+            output = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                num_return_sequences=1,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        self.batches += 1
+        self.prompts += len(prompts)
+        prompt_len = inputs["input_ids"].shape[1]
+        return self.tokenizer.batch_decode(
+            output[:, prompt_len:], skip_special_tokens=True
+        )
+
+
+# Resident HF models keyed by (model_name, device), loaded on first use
+_hf_models: dict[tuple, HFModelRunner] = {}
+
+
+def get_hf_model(model_name: str, device: str = None) -> HFModelRunner:
+    """Shared runner of a local HF model, device defaults to HF_DEVICE or cpu
+
+    The model itself is loaded by the runner's first generate() or load().
+    """
+    device = device or os.getenv("HF_DEVICE", "cpu")
+    runner = _hf_models.get((model_name, device))
+    if runner is None:
+        runner = _hf_models[(model_name, device)] = HFModelRunner(model_name, device)
+    return runner
+
+
 def initialize_hf_model(model_name):
-    hf_tokenizer = AutoTokenizer.from_pretrained(
-        model_name, device_map="auto", trust_remote_code=True
-    )
-    hf_model = AutoModelForCausalLM.from_pretrained(
-        model_name, device_map="auto", trust_remote_code=True
-    )
-    if hf_tokenizer.pad_token is None:
-        hf_tokenizer.pad_token = hf_tokenizer.eos_token
+    """Blocking load of a shared local HF model, returns (model, tokenizer)"""
+    runner = get_hf_model(model_name)
+    runner._executor.submit(runner._load).result()
+    return runner.model, runner.tokenizer
 
-    return hf_model, hf_tokenizer
 
+def close_local_models():
+    """Stop the worker threads of the local models, they are reloaded on next use"""
+    for runner in _hf_models.values():
+        runner.close()
+    _hf_models.clear()
+    for service in _hf_embedding_services.values():
+        service.close()
+    _hf_embedding_services.clear()
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=4, max=10),
-    retry=retry_if_exception_type(
-        (RateLimitError, APIConnectionError, APITimeoutError)
-    ),
-)
-async def hf_model_if_cache(
-    model,
-    prompt,
-    system_prompt=None,
-    history_messages=[],
-    **kwargs,
-) -> str:
-    model_name = model
-    hf_model, hf_tokenizer = initialize_hf_model(model_name)
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    messages.extend(history_messages)
-    messages.append({"role": "user", "content": prompt})
-    kwargs.pop("hashing_kv", None)
+
+def _hf_chat_prompt(hf_tokenizer, messages: list[dict]) -> str:
     input_prompt = ""
     try:
         input_prompt = hf_tokenizer.apply_chat_template(
@@ -343,19 +661,35 @@ async def hf_model_if_cache(
                     + ori_message[msgid]["role"]
                     + ">\n"
                 )
+    return input_prompt
 
-    input_ids = hf_tokenizer(
-        input_prompt, return_tensors="pt", padding=True, truncation=True
-    ).to("cuda")
-    inputs = {k: v.to(hf_model.device) for k, v in input_ids.items()}
-    output = hf_model.generate(
-        **input_ids, max_new_tokens=512, num_return_sequences=1, early_stopping=True
-    )
-    response_text = hf_tokenizer.decode(
-        output[0][len(inputs["input_ids"][0]) :], skip_special_tokens=True
-    )
 
-    return response_text
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    retry=retry_if_exception_type(
+        (RateLimitError, APIConnectionError, APITimeoutError)
+    ),
+)
+async def hf_model_if_cache(
+    model,
+    prompt,
+    system_prompt=None,
+    history_messages=[],
+    **kwargs,
+) -> str:
+    runner = get_hf_model(model, kwargs.pop("device", None))
+    await runner.load()
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.extend(history_messages)
+    messages.append({"role": "user", "content": prompt})
+    kwargs.pop("hashing_kv", None)
+    input_prompt = _hf_chat_prompt(runner.tokenizer, messages)
+    return await runner.generate(
+        input_prompt, kwargs.get("max_new_tokens", HF_MAX_NEW_TOKENS)
+    )
 
 
 @retry(
@@ -378,7 +712,7 @@ async def ollama_model_if_cache(
     host = kwargs.pop("host", None)
     timeout = kwargs.pop("timeout", None)
     kwargs.pop("hashing_kv", None)
-    ollama_client = ollama.AsyncClient(host=host, timeout=timeout)
+    ollama_client = get_ollama_client(host, timeout=timeout)
     messages = []
     if system_prompt:
         messages.append({"role": "system", "content": system_prompt})
@@ -436,22 +770,22 @@ async def lollms_model_if_cache(
 
     request_data["prompt"] = full_prompt
 
-    async with aiohttp.ClientSession() as session:
-        if stream:
-
-            async def inner():
-                async with session.post(
-                    f"{base_url}/lollms_generate", json=request_data
-                ) as response:
-                    async for line in response.content:
-                        yield line.decode().strip()
+    session = get_http_session()
+    if stream:
 
-            return inner()
-        else:
+        async def inner():
             async with session.post(
                 f"{base_url}/lollms_generate", json=request_data
             ) as response:
-                return await response.text()
+                async for line in response.content:
+                    yield line.decode().strip()
+
+        return inner()
+    else:
+        async with session.post(
+            f"{base_url}/lollms_generate", json=request_data
+        ) as response:
+            return await response.text()
 
 
 @lru_cache(maxsize=1)
@@ -923,24 +1257,22 @@ async def openai_embedding(
     base_url: str = None,
     api_key: str = None,
 ) -> np.ndarray:
-    if api_key:
-        os.environ["OPENAI_API_KEY"] = api_key
-
-    openai_async_client = (
-        AsyncOpenAI() if base_url is None else AsyncOpenAI(base_url=base_url)
-    )
+    openai_async_client = get_openai_client(base_url, api_key)
+    limiter = get_rate_limiter("openai", base_url, api_key)
+    estimated = estimate_tokens(texts)
+    await limiter.acquire(estimated)
     response = await openai_async_client.embeddings.create(
         model=model, input=texts, encoding_format="float"
     )
+    _reconcile_usage(limiter, estimated, response)
     return np.array([dp.embedding for dp in response.data])
 
 
 async def fetch_data(url, headers, data):
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=data) as response:
-            response_json = await response.json()
-            data_list = response_json.get("data", [])
-            return data_list
+    async with get_http_session().post(url, headers=headers, json=data) as response:
+        response_json = await response.json()
+        data_list = response_json.get("data", [])
+        return data_list
 
 
 async def jina_embedding(
@@ -950,12 +1282,11 @@ async def jina_embedding(
     base_url: str = None,
     api_key: str = None,
 ) -> np.ndarray:
-    if api_key:
-        os.environ["JINA_API_KEY"] = api_key
+    api_key = api_key or os.environ["JINA_API_KEY"]
     url = "https://api.jina.ai/v1/embeddings" if not base_url else base_url
     headers = {
         "Content-Type": "application/json",
-        "Authorization": f"Bearer {os.environ['JINA_API_KEY']}",
+        "Authorization": f"Bearer {api_key}",
     }
     data = {
         "model": "jina-embeddings-v3",
@@ -987,12 +1318,7 @@ async def nvidia_openai_embedding(
     trunc: str = "NONE",  # NONE or START or END
     encode: str = "float",  # float or base64
 ) -> np.ndarray:
-    if api_key:
-        os.environ["OPENAI_API_KEY"] = api_key
-
-    openai_async_client = (
-        AsyncOpenAI() if base_url is None else AsyncOpenAI(base_url=base_url)
-    )
+    openai_async_client = get_openai_client(base_url, api_key)
     response = await openai_async_client.embeddings.create(
         model=model,
         input=texts,
@@ -1017,18 +1343,7 @@ async def azure_openai_embedding(
     api_key: str = None,
     api_version: str = None,
 ) -> np.ndarray:
-    if api_key:
-        os.environ["AZURE_OPENAI_API_KEY"] = api_key
-    if base_url:
-        os.environ["AZURE_OPENAI_ENDPOINT"] = base_url
-    if api_version:
-        os.environ["AZURE_OPENAI_API_VERSION"] = api_version
-
-    openai_async_client = AsyncAzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-    )
+    openai_async_client = get_azure_openai_client(base_url, api_key, api_version)
 
     response = await openai_async_client.embeddings.create(
         model=model, input=texts, encoding_format="float"
@@ -1060,12 +1375,13 @@ async def siliconcloud_embedding(
     payload = {"model": model, "input": truncate_texts, "encoding_format": "base64"}
 
     base64_strings = []
-    async with aiohttp.ClientSession() as session:
-        async with session.post(base_url, headers=headers, json=payload) as response:
-            content = await response.json()
-            if "code" in content:
-                raise ValueError(content)
-            base64_strings = [item["embedding"] for item in content["data"]]
+    async with get_http_session().post(
+        base_url, headers=headers, json=payload
+    ) as response:
+        content = await response.json()
+        if "code" in content:
+            raise ValueError(content)
+        base64_strings = [item["embedding"] for item in content["data"]]
 
     embeddings = []
     for string in base64_strings:
@@ -1148,18 +1464,118 @@ async def bedrock_embedding(
         return np.array(embed_texts)
 
 
+# Texts queued by concurrent hf_embedding calls are embedded together in
+# batches of up to HF_EMBED_MAX_BATCH_SIZE, waiting HF_EMBED_BATCH_WINDOW
+# seconds for company
+HF_EMBED_BATCH_WINDOW = 0.005
+HF_EMBED_MAX_BATCH_SIZE = 32
+
+
+class HFEmbeddingService:
+    """Local embedding service owning a tokenizer and encoder model.
+
+    Texts from concurrent callers are queued, sorted by length and cut into
+    batches of similar lengths so little compute is spent on padding. Each
+    batch runs under torch.inference_mode in a dedicated worker thread, the
+    event loop is never blocked by a forward pass. Embeddings are the mean of
+    the last hidden states over the attention mask, as float32 arrays.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        embed_model,
+        batch_window: float = HF_EMBED_BATCH_WINDOW,
+        max_batch_size: int = HF_EMBED_MAX_BATCH_SIZE,
+    ):
+        self.tokenizer = tokenizer
+        self.embed_model = embed_model
+        self.device = next(embed_model.parameters()).device
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="hf-embed"
+        )
+        self._queue: list[tuple[str, asyncio.Future]] = []
+        self._worker: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.texts = 0
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        if not texts:
+            hidden_size = getattr(self.embed_model.config, "hidden_size", 0)
+            return np.empty((0, hidden_size), dtype=np.float32)
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in texts]
+        self._queue.extend(zip(texts, futures))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._serve())
+        return np.stack(await asyncio.gather(*futures))
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        while self._queue:
+            if self.batch_window > 0 and len(self._queue) < self.max_batch_size:
+                await asyncio.sleep(self.batch_window)
+            pending = [q for q in self._queue if not q[1].done()]
+            self._queue = []
+            # Length buckets: neighbours in length pad to about the same size
+            pending.sort(key=lambda q: len(q[0]))
+            for start in range(0, len(pending), self.max_batch_size):
+                batch = pending[start : start + self.max_batch_size]
+                try:
+                    rows = await loop.run_in_executor(
+                        self._executor, self._embed_batch, [t for t, _ in batch]
+                    )
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, future), row in zip(batch, rows):
+                    if not future.done():
+                        future.set_result(row)
+
+    def _embed_batch(self, texts: list[str]) -> np.ndarray:
+        inputs = self.tokenizer(
+            texts, return_tensors="pt", padding=True, truncation=True
+        ).to(self.device)
+        with torch.inference_mode():
+            outputs = self.embed_model(
+                input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"]
+            )
+            hidden = outputs.last_hidden_state
+            mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            embeddings = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        self.batches += 1
+        self.texts += len(texts)
+        return embeddings.to(torch.float32).cpu().numpy()
+
+
+# One embedding service per local model, created on first use
+_hf_embedding_services: dict[tuple[int, int], HFEmbeddingService] = {}
+
+
+def get_hf_embedding_service(tokenizer, embed_model) -> HFEmbeddingService:
+    """Shared embedding service of a loaded tokenizer and model
+
+    The service keeps both objects alive, so their ids stay unique while it
+    is registered.
+    """
+    key = (id(tokenizer), id(embed_model))
+    service = _hf_embedding_services.get(key)
+    if service is None:
+        service = _hf_embedding_services[key] = HFEmbeddingService(
+            tokenizer, embed_model
+        )
+    return service
+
+
 async def hf_embedding(texts: list[str], tokenizer, embed_model) -> np.ndarray:
-    device = next(embed_model.parameters()).device
-    input_ids = tokenizer(
-        texts, return_tensors="pt", padding=True, truncation=True
-    ).input_ids.to(device)
-    with torch.no_grad():
-        outputs = embed_model(input_ids)
-        embeddings = outputs.last_hidden_state.mean(dim=1)
-    if embeddings.dtype == torch.bfloat16:
-        return embeddings.detach().to(torch.float32).cpu().numpy()
-    else:
-        return embeddings.detach().cpu().numpy()
+    return await get_hf_embedding_service(tokenizer, embed_model).embed(texts)
 
 
 async def ollama_embedding(texts: list[str], embed_model, **kwargs) -> np.ndarray:
@@ -1176,8 +1592,8 @@ async def ollama_embedding(texts: list[str], embed_model, **kwargs) -> np.ndarra
 
 
 async def ollama_embed(texts: list[str], embed_model, **kwargs) -> np.ndarray:
-    ollama_client = ollama.Client(**kwargs)
-    data = ollama_client.embed(model=embed_model, input=texts)
+    ollama_client = get_ollama_client(**kwargs)
+    data = await ollama_client.embed(model=embed_model, input=texts)
     return data["embeddings"]
 
 
@@ -1196,18 +1612,18 @@ async def lollms_embed(
     Returns:
         np.ndarray: Array of embeddings
     """
-    async with aiohttp.ClientSession() as session:
-        embeddings = []
-        for text in texts:
-            request_data = {"text": text}
+    session = get_http_session()
+    embeddings = []
+    for text in texts:
+        request_data = {"text": text}
 
-            async with session.post(
-                f"{base_url}/lollms_embed", json=request_data
-            ) as response:
-                result = await response.json()
-                embeddings.append(result["vector"])
+        async with session.post(
+            f"{base_url}/lollms_embed", json=request_data
+        ) as response:
+            result = await response.json()
+            embeddings.append(result["vector"])
 
-        return np.array(embeddings)
+    return np.array(embeddings)
 
 
 class Model(BaseModel):
@@ -1240,6 +1656,72 @@ class Model(BaseModel):
         arbitrary_types_allowed = True
 
 
+# Gen funcs that call OpenAI through the shared rate limiters
+_OPENAI_GEN_FUNCS = (
+    openai_complete_if_cache,
+    openai_complete,
+    gpt_4o_complete,
+    gpt_4o_mini_complete,
+)
+
+
+class _ModelHealth:
+    """Latency, error and circuit breaker state of one MultiModel entry"""
+
+    # Number of recent latencies kept for the hedging percentile
+    WINDOW = 100
+    # Samples needed before hedging on a model's percentile
+    MIN_SAMPLES = 20
+
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trial_running = False
+        self.recent: deque = deque(maxlen=self.WINDOW)
+
+    def available(self, now: float) -> bool:
+        if self.consecutive_failures == 0 or now >= self.open_until:
+            # Half-open after the cooldown: only one trial call at a time
+            return not (self.open_until and self.trial_running)
+        return False
+
+    def begin(self, now: float):
+        self.in_flight += 1
+        if self.open_until and now >= self.open_until:
+            self.trial_running = True
+
+    def record_success(self, latency: float, alpha: float):
+        self.in_flight -= 1
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = alpha * latency + (1 - alpha) * self.latency
+        self.error_rate *= 1 - alpha
+        self.recent.append(latency)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trial_running = False
+
+    def record_failure(self, alpha: float, threshold: int, cooldown: float):
+        self.in_flight -= 1
+        self.error_rate = alpha + (1 - alpha) * self.error_rate
+        self.consecutive_failures += 1
+        if self.trial_running or self.consecutive_failures >= threshold:
+            self.open_until = time.monotonic() + cooldown
+            logger.warning(
+                f"Ejecting model after {self.consecutive_failures} failures for {cooldown}s"
+            )
+        self.trial_running = False
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        if len(self.recent) < self.MIN_SAMPLES:
+            return None
+        return float(np.percentile(self.recent, percentile * 100))
+
+
 class MultiModel:
     """
     Distributes the load across multiple language models. Useful for circumventing low rate limits with certain api providers especially if you are on the free tier.
@@ -1263,15 +1745,120 @@ class MultiModel:
             / ..other args
             )
         ```
+
+    Models are picked by health instead of round-robin: each keeps an EWMA of
+    its latency and error rate plus its remaining rate-limit budget, and the
+    lowest-cost one wins. A model failing failure_threshold times in a row is
+    ejected for cooldown seconds, then gets a single trial call. With
+    hedge_percentile set (eg. 0.95), a call still running after that latency
+    percentile of its model is also sent to the next best model and the
+    first answer wins.
     """
 
-    def __init__(self, models: List[Model]):
+    def __init__(
+        self,
+        models: List[Model],
+        hedge_percentile: Optional[float] = None,
+        failure_threshold: int = 5,
+        cooldown: float = 30.0,
+        ewma_alpha: float = 0.2,
+    ):
         self._models = models
         self._current_model = 0
+        self.hedge_percentile = hedge_percentile
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.ewma_alpha = ewma_alpha
+        self._health = [_ModelHealth() for _ in models]
+        self.hedged = 0
+
+    def _budget(self, model: Model) -> Optional[float]:
+        if model.gen_func not in _OPENAI_GEN_FUNCS:
+            return None
+        return get_rate_limiter(
+            "openai", model.kwargs.get("base_url"), model.kwargs.get("api_key")
+        ).budget()
+
+    def _cost(self, index: int) -> float:
+        health = self._health[index]
+        latency = health.latency
+        if latency is None:
+            # Untried models cost nothing so every model gets sampled, models
+            # that only ever failed cost as much as the slowest one
+            known = [h.latency for h in self._health if h.latency is not None]
+            latency = max(known, default=1.0) if health.error_rate else 0.0
+        cost = latency * (1 + health.in_flight) * (1 + 4 * health.error_rate)
+        budget = self._budget(self._models[index])
+        if budget is not None:
+            cost = (cost + 0.001) / max(budget, 0.01)
+        return cost
+
+    def _ranked_models(self, exclude: int = None) -> List[int]:
+        now = time.monotonic()
+        # Rotate the start so equally good models still share the load
+        self._current_model = (self._current_model + 1) % len(self._models)
+        order = [
+            (self._current_model + i) % len(self._models)
+            for i in range(len(self._models))
+            if (self._current_model + i) % len(self._models) != exclude
+        ]
+        available = [i for i in order if self._health[i].available(now)]
+        if not available:
+            # Everything is ejected, try whichever comes back first
+            return sorted(order, key=lambda i: self._health[i].open_until)[:1]
+        # Models back from ejection get their trial call first
+        return sorted(
+            available, key=lambda i: (not self._health[i].open_until, self._cost(i))
+        )
 
     def _next_model(self):
-        self._current_model = (self._current_model + 1) % len(self._models)
-        return self._models[self._current_model]
+        return self._models[self._ranked_models()[0]]
+
+    async def _call(self, index: int, args: dict):
+        model = self._models[index]
+        health = self._health[index]
+        health.begin(time.monotonic())
+        start = time.monotonic()
+        try:
+            result = await model.gen_func(**args, **model.kwargs)
+        except asyncio.CancelledError:
+            # A cancelled hedge says nothing about the model's health
+            health.in_flight -= 1
+            health.trial_running = False
+            raise
+        except Exception:
+            health.record_failure(
+                self.ewma_alpha, self.failure_threshold, self.cooldown
+            )
+            raise
+        health.record_success(time.monotonic() - start, self.ewma_alpha)
+        return result
+
+    async def _hedged_call(self, index: int, args: dict):
+        delay = self._health[index].latency_percentile(self.hedge_percentile)
+        primary = asyncio.ensure_future(self._call(index, args))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        backup_index = self._ranked_models(exclude=index)[0]
+        if backup_index == index:
+            return await primary
+        self.hedged += 1
+        pending = {primary, asyncio.ensure_future(self._call(backup_index, args))}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
 
     async def llm_model_func(
         self, prompt, system_prompt=None, history_messages=[], **kwargs
@@ -1279,16 +1866,36 @@ class MultiModel:
         kwargs.pop("model", None)  # stop from overwriting the custom model name
         kwargs.pop("keyword_extraction", None)
         kwargs.pop("mode", None)
-        next_model = self._next_model()
+        index = self._ranked_models()[0]
         args = dict(
             prompt=prompt,
             system_prompt=system_prompt,
             history_messages=history_messages,
             **kwargs,
-            **next_model.kwargs,
         )
-
-        return await next_model.gen_func(**args)
+        if (
+            self.hedge_percentile
+            and len(self._models) > 1
+            and not kwargs.get("stream")
+            and self._health[index].latency_percentile(self.hedge_percentile)
+        ):
+            return await self._hedged_call(index, args)
+        return await self._call(index, args)
+
+    def stats(self) -> List[dict]:
+        """Health of every model, in the configured order"""
+        now = time.monotonic()
+        return [
+            {
+                "model": model.kwargs.get("model"),
+                "latency": health.latency,
+                "error_rate": health.error_rate,
+                "in_flight": health.in_flight,
+                "ejected": not health.available(now),
+                "budget": self._budget(model),
+            }
+            for model, health in zip(self._models, self._health)
+        ]
 
 
 if __name__ == "__main__":
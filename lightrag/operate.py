@@ -1,25 +1,32 @@
 import asyncio
 import json
 import re
+from dataclasses import replace
 from tqdm.asyncio import tqdm as tqdm_async
 from typing import Union
 from collections import Counter, defaultdict
+from datetime import datetime
 from .utils import (
     logger,
     clean_str,
     compute_mdhash_id,
     decode_tokens_by_tiktoken,
     encode_string_by_tiktoken,
+    encode_strings_by_tiktoken,
     is_float_regex,
     list_of_list_to_csv,
     pack_user_ass_to_openai_messages,
     split_string_by_multi_markers,
     truncate_list_by_token_size,
-    process_combine_contexts,
     compute_args_hash,
     handle_cache,
+    prefetch_query_embeddings,
     save_to_cache,
+    SingleFlight,
     CacheData,
+    MinHashIndex,
+    TokenizerService,
+    get_tokenizer_service,
 )
 from .base import (
     BaseGraphStorage,
@@ -27,6 +34,11 @@ from .base import (
     BaseVectorStorage,
     TextChunkSchema,
     QueryParam,
+    ChunkStatus,
+    QueryContext,
+    EntityContext,
+    RelationContext,
+    SourceContext,
 )
 from .prompt import GRAPH_FIELD_SEP, PROMPTS
 import time
@@ -84,10 +96,164 @@ def chunking_by_token_size(
     return results
 
 
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s+")
+_WORD = re.compile(r"\s*\S+")
+
+
+def _split_spans(content: str, start: int, end: int, pattern: re.Pattern) -> list:
+    """Split content[start:end] at pattern matches into stripped (start, end) spans"""
+    spans = []
+    piece_start = start
+    for match in pattern.finditer(content, start, end):
+        spans.append((piece_start, match.start()))
+        piece_start = match.end()
+    spans.append((piece_start, end))
+    stripped = []
+    for s, e in spans:
+        text = content[s:e]
+        s += len(text) - len(text.lstrip())
+        e -= len(text) - len(text.rstrip())
+        if e > s:
+            stripped.append((s, e))
+    return stripped
+
+
+def chunking_by_structure(
+    content: str,
+    split_by_character=None,
+    overlap_token_size=128,
+    max_token_size=1024,
+    tiktoken_model="gpt-4o-mini",
+):
+    """Chunk on paragraph and sentence boundaries, packed up to max_token_size
+
+    Sentences are tokenized once with the batch encoder and never decoded back;
+    chunks are slices of content and record their (start_char, end_char)
+    offsets. Overlap is made of whole trailing sentences of the previous chunk.
+    Sentences longer than max_token_size are split between words. With
+    split_by_character, chunks never cross a split_by_character boundary.
+    Token counts are the sum of the sentence counts, so they can differ
+    slightly from encoding the chunk as a whole.
+    """
+    if split_by_character:
+        sections = []
+        section_start = 0
+        for piece in content.split(split_by_character):
+            sections.append((section_start, section_start + len(piece)))
+            section_start += len(piece) + len(split_by_character)
+    else:
+        sections = [(0, len(content))]
+
+    # Sentence spans per section
+    section_units = []
+    for section in sections:
+        units = []
+        for paragraph in _split_spans(content, *section, _PARAGRAPH_BREAK):
+            units.extend(_split_spans(content, *paragraph, _SENTENCE_END))
+        section_units.append(units)
+
+    # Count each sentence with the whitespace before it, the way it is
+    # tokenized inside a chunk
+    all_units, count_texts = [], []
+    for units in section_units:
+        prev_end = None
+        for s, e in units:
+            all_units.append((s, e))
+            count_texts.append(content[s if prev_end is None else prev_end : e])
+            prev_end = e
+    counts = dict(
+        zip(
+            all_units,
+            map(
+                len, encode_strings_by_tiktoken(count_texts, model_name=tiktoken_model)
+            ),
+        )
+    )
+
+    # Split over-long sentences between words
+    long_units = [unit for unit in all_units if counts[unit] > max_token_size]
+    if long_units:
+        words = {
+            unit: [m.span() for m in _WORD.finditer(content, *unit)]
+            for unit in long_units
+        }
+        all_words = [w for unit in long_units for w in words[unit]]
+        word_counts = dict(
+            zip(
+                all_words,
+                map(
+                    len,
+                    encode_strings_by_tiktoken(
+                        [content[s:e] for s, e in all_words], model_name=tiktoken_model
+                    ),
+                ),
+            )
+        )
+        for units in section_units:
+            split_units = []
+            for unit in units:
+                if unit not in words:
+                    split_units.append(unit)
+                    continue
+                piece, piece_tokens = None, 0
+                for word in words[unit]:
+                    if (
+                        piece is not None
+                        and piece_tokens + word_counts[word] > max_token_size
+                    ):
+                        split_units.append(piece)
+                        counts[piece] = piece_tokens
+                        piece, piece_tokens = None, 0
+                    if piece is None:
+                        text = content[word[0] : word[1]]
+                        piece = (word[0] + len(text) - len(text.lstrip()), word[1])
+                    else:
+                        piece = (piece[0], word[1])
+                    piece_tokens += word_counts[word]
+                if piece is not None:
+                    split_units.append(piece)
+                    counts[piece] = piece_tokens
+            units[:] = split_units
+
+    results = []
+    for units in section_units:
+        window, window_tokens = [], 0
+        for index, unit in enumerate(units):
+            if window and window_tokens + counts[unit] > max_token_size:
+                results.append((window, window_tokens))
+                # Carry whole trailing sentences as overlap
+                overlap, overlap_tokens = [], 0
+                for prev in reversed(window):
+                    if overlap_tokens + counts[prev] > overlap_token_size:
+                        break
+                    if overlap_tokens + counts[prev] + counts[unit] > max_token_size:
+                        break
+                    overlap.insert(0, prev)
+                    overlap_tokens += counts[prev]
+                window, window_tokens = overlap, overlap_tokens
+            window.append(unit)
+            window_tokens += counts[unit]
+        if window:
+            results.append((window, window_tokens))
+
+    return [
+        {
+            "tokens": window_tokens,
+            "content": content[window[0][0] : window[-1][1]],
+            "chunk_order_index": index,
+            "start_char": window[0][0],
+            "end_char": window[-1][1],
+        }
+        for index, (window, window_tokens) in enumerate(results)
+    ]
+
+
 async def _handle_entity_relation_summary(
     entity_or_relation_name: str,
     description: str,
     global_config: dict,
+    tokens: list[int] = None,
 ) -> str:
     use_llm_func: callable = global_config["llm_model_func"]
     llm_max_tokens = global_config["llm_model_max_token_size"]
@@ -97,7 +263,8 @@ async def _handle_entity_relation_summary(
         "language", PROMPTS["DEFAULT_LANGUAGE"]
     )
 
-    tokens = encode_string_by_tiktoken(description, model_name=tiktoken_model_name)
+    if tokens is None:
+        tokens = await _tokenizer(global_config).encode(description)
     if len(tokens) < summary_max_tokens:  # No need for summary
         return description
     prompt_template = PROMPTS["summarize_entity_descriptions"]
@@ -115,6 +282,50 @@ async def _handle_entity_relation_summary(
     return summary
 
 
+def _tokenizer(global_config: dict) -> TokenizerService:
+    return get_tokenizer_service(
+        global_config["tiktoken_model_name"],
+        global_config.get("tokenizer_max_workers", 4),
+    )
+
+
+async def _count_tokens(content: str, global_config: dict) -> int:
+    return len(await _tokenizer(global_config).encode(content))
+
+
+async def _summarize_or_defer(
+    name: Union[str, tuple[str, str]],
+    description: str,
+    global_config: dict,
+    pending_summaries: set = None,
+    tokens: list[int] = None,
+    merge_stats: dict = None,
+) -> tuple[str, int]:
+    """Summarize an over-budget description now, or queue it for compaction
+
+    The description is tokenized once (or not at all when its tokens are
+    given), only a newly generated summary is counted again. Summary LLM calls
+    are counted in merge_stats["summaries"] when given.
+
+    Returns:
+        The description to store and its token count
+    """
+    if tokens is None:
+        tokens = await _tokenizer(global_config).encode(description)
+    if len(tokens) < global_config["entity_summary_to_max_tokens"]:
+        return description, len(tokens)
+    if global_config.get("defer_entity_summary") and pending_summaries is not None:
+        pending_summaries.add(name)
+        return description, len(tokens)
+    summary_name = name if isinstance(name, str) else f"({name[0]}, {name[1]})"
+    summary = await _handle_entity_relation_summary(
+        summary_name, description, global_config, tokens=tokens
+    )
+    if merge_stats is not None:
+        merge_stats["summaries"] += 1
+    return summary, await _count_tokens(summary, global_config)
+
+
 async def _handle_single_entity_extraction(
     record_attributes: list[str],
     chunk_key: str,
@@ -168,6 +379,8 @@ async def _merge_nodes_then_upsert(
     nodes_data: list[dict],
     knowledge_graph_inst: BaseGraphStorage,
     global_config: dict,
+    pending_summaries: set = None,
+    merge_stats: dict = None,
 ):
     already_entity_types = []
     already_source_ids = []
@@ -194,12 +407,17 @@ async def _merge_nodes_then_upsert(
     source_id = GRAPH_FIELD_SEP.join(
         set([dp["source_id"] for dp in nodes_data] + already_source_ids)
     )
-    description = await _handle_entity_relation_summary(
-        entity_name, description, global_config
+    description, description_tokens = await _summarize_or_defer(
+        entity_name,
+        description,
+        global_config,
+        pending_summaries,
+        merge_stats=merge_stats,
     )
     node_data = dict(
         entity_type=entity_type,
         description=description,
+        description_tokens=description_tokens,
         source_id=source_id,
     )
     await knowledge_graph_inst.upsert_node(
@@ -216,6 +434,8 @@ async def _merge_edges_then_upsert(
     edges_data: list[dict],
     knowledge_graph_inst: BaseGraphStorage,
     global_config: dict,
+    pending_summaries: set = None,
+    merge_stats: dict = None,
 ):
     already_weights = []
     already_source_ids = []
@@ -243,6 +463,7 @@ async def _merge_edges_then_upsert(
     source_id = GRAPH_FIELD_SEP.join(
         set([dp["source_id"] for dp in edges_data] + already_source_ids)
     )
+    tokens = await _tokenizer(global_config).encode(description)
     for need_insert_id in [src_id, tgt_id]:
         if not (await knowledge_graph_inst.has_node(need_insert_id)):
             await knowledge_graph_inst.upsert_node(
@@ -250,11 +471,17 @@ async def _merge_edges_then_upsert(
                 node_data={
                     "source_id": source_id,
                     "description": description,
+                    "description_tokens": len(tokens),
                     "entity_type": '"UNKNOWN"',
                 },
             )
-    description = await _handle_entity_relation_summary(
-        f"({src_id}, {tgt_id})", description, global_config
+    description, description_tokens = await _summarize_or_defer(
+        (src_id, tgt_id),
+        description,
+        global_config,
+        pending_summaries,
+        tokens=tokens,
+        merge_stats=merge_stats,
     )
     await knowledge_graph_inst.upsert_edge(
         src_id,
@@ -262,6 +489,7 @@ async def _merge_edges_then_upsert(
         edge_data=dict(
             weight=weight,
             description=description,
+            description_tokens=description_tokens,
             keywords=keywords,
             source_id=source_id,
         ),
@@ -277,6 +505,25 @@ async def _merge_edges_then_upsert(
     return edge_data
 
 
+def _chunk_records_to_status(maybe_nodes: dict, maybe_edges: dict) -> dict:
+    """Flatten extraction results of a chunk into a JSON friendly record"""
+    return {
+        "nodes": [dp for dps in maybe_nodes.values() for dp in dps],
+        "edges": [dp for dps in maybe_edges.values() for dp in dps],
+    }
+
+
+def _chunk_records_from_status(status: dict) -> tuple[dict, dict]:
+    """Rebuild the grouped extraction results saved by _chunk_records_to_status"""
+    maybe_nodes = defaultdict(list)
+    maybe_edges = defaultdict(list)
+    for dp in status.get("nodes", []):
+        maybe_nodes[dp["entity_name"]].append(dp)
+    for dp in status.get("edges", []):
+        maybe_edges[(dp["src_id"], dp["tgt_id"])].append(dp)
+    return dict(maybe_nodes), dict(maybe_edges)
+
+
 async def extract_entities(
     chunks: dict[str, TextChunkSchema],
     knowledge_graph_inst: BaseGraphStorage,
@@ -284,7 +531,53 @@ async def extract_entities(
     relationships_vdb: BaseVectorStorage,
     global_config: dict,
     llm_response_cache: BaseKVStorage = None,
+    chunk_status: BaseKVStorage = None,
+    chunk_dedup: MinHashIndex = None,
+    llm_flights: SingleFlight = None,
 ) -> Union[BaseGraphStorage, None]:
+    chunk_results = await extract_chunk_records(
+        chunks,
+        global_config,
+        llm_response_cache=llm_response_cache,
+        chunk_status=chunk_status,
+        chunk_dedup=chunk_dedup,
+        llm_flights=llm_flights,
+    )
+    if chunks and not chunk_results:
+        logger.info("All chunks have been merged before, skip entity extraction")
+        return knowledge_graph_inst
+
+    maybe_new_kg = await merge_chunk_records(
+        chunk_results,
+        knowledge_graph_inst,
+        entity_vdb,
+        relationships_vdb,
+        global_config,
+    )
+    if maybe_new_kg is not None:
+        await mark_chunks_merged(chunk_status, chunk_results)
+    return maybe_new_kg
+
+
+async def extract_chunk_records(
+    chunks: dict[str, TextChunkSchema],
+    global_config: dict,
+    llm_response_cache: BaseKVStorage = None,
+    chunk_status: BaseKVStorage = None,
+    chunk_dedup: MinHashIndex = None,
+    llm_flights: SingleFlight = None,
+) -> dict[str, tuple[dict, dict]]:
+    """Run the LLM entity extraction of every chunk
+
+    With a chunk_status storage, parsed results are checkpointed per chunk:
+    extracted chunks are not sent to the LLM again and merged chunks are skipped.
+    With a chunk_dedup index, a chunk that is a near-duplicate of an extracted
+    or in-flight chunk reuses the records of that twin instead of calling the LLM.
+    With llm_flights, identical cache-missing prompts in flight share one LLM call.
+
+    Returns:
+        Mapping of chunk id to its (maybe_nodes, maybe_edges), merged chunks excluded
+    """
     use_llm_func: callable = global_config["llm_model_func"]
     entity_extract_max_gleaning = global_config["entity_extract_max_gleaning"]
     enable_llm_cache_for_entity_extract: bool = global_config[
@@ -292,6 +585,18 @@ async def extract_entities(
     ]
 
     ordered_chunks = list(chunks.items())
+    known_status = {}
+    if chunk_status is not None and ordered_chunks:
+        for (chunk_key, _), status in zip(
+            ordered_chunks, await chunk_status.get_by_ids(list(chunks.keys()))
+        ):
+            if status is not None:
+                known_status[chunk_key] = status
+        ordered_chunks = [
+            c
+            for c in ordered_chunks
+            if known_status.get(c[0], {}).get("status") != ChunkStatus.MERGED
+        ]
     # add language and example number params to prompt
     language = global_config["addon_params"].get(
         "language", PROMPTS["DEFAULT_LANGUAGE"]
@@ -363,28 +668,113 @@ async def extract_entities(
             if cached_return:
                 return cached_return
 
-            if history_messages:
-                res: str = await use_llm_func(
-                    input_text, history_messages=history_messages
+            async def _call_and_cache() -> str:
+                if history_messages:
+                    res: str = await use_llm_func(
+                        input_text, history_messages=history_messages
+                    )
+                else:
+                    res: str = await use_llm_func(input_text)
+                await save_to_cache(
+                    llm_response_cache,
+                    CacheData(args_hash=arg_hash, content=res, prompt=_prompt),
                 )
-            else:
-                res: str = await use_llm_func(input_text)
-            await save_to_cache(
-                llm_response_cache,
-                CacheData(args_hash=arg_hash, content=res, prompt=_prompt),
-            )
-            return res
+                return res
+
+            if llm_flights is None:
+                return await _call_and_cache()
+            return await llm_flights.do(("default", arg_hash), _call_and_cache)
 
         if history_messages:
             return await use_llm_func(input_text, history_messages=history_messages)
         else:
             return await use_llm_func(input_text)
 
+    async def _twin_records(twin_key: str) -> Union[tuple[tuple, int], None]:
+        if twin_key in chunk_dedup.inflight:
+            return await chunk_dedup.inflight[twin_key]
+        if chunk_status is None:
+            return None
+        twin_status = await chunk_status.get_by_id(twin_key)
+        if twin_status is None or "nodes" not in twin_status:
+            return None
+        return _chunk_records_from_status(twin_status), twin_status.get("llm_calls", 1)
+
     async def _process_single_content(chunk_key_dp: tuple[str, TextChunkSchema]):
         nonlocal already_processed, already_entities, already_relations
         chunk_key = chunk_key_dp[0]
         chunk_dp = chunk_key_dp[1]
+        status = known_status.get(chunk_key)
+        if status is not None and status.get("status") == ChunkStatus.EXTRACTED:
+            # Extracted by an earlier, interrupted run
+            already_processed += 1
+            return chunk_key, _chunk_records_from_status(status)
+        content = chunk_dp["content"]
+
+        if chunk_dedup is None:
+            _, records, _ = await _extract_single_content(chunk_key, chunk_dp, status)
+            return chunk_key, records
+
+        signature = chunk_dedup.signature(content)
+        twin_key = chunk_dedup.query(signature, exclude=chunk_key)
+        twin = await _twin_records(twin_key) if twin_key is not None else None
+        if twin is not None:
+            (twin_nodes, twin_edges), twin_llm_calls = twin
+            maybe_nodes = {
+                k: [{**dp, "source_id": chunk_key} for dp in v]
+                for k, v in twin_nodes.items()
+            }
+            maybe_edges = {
+                k: [{**dp, "source_id": chunk_key} for dp in v]
+                for k, v in twin_edges.items()
+            }
+            chunk_dedup.stats["duplicates"] += 1
+            chunk_dedup.stats["llm_calls_avoided"] += twin_llm_calls
+            already_processed += 1
+            if chunk_status is not None:
+                await chunk_status.upsert(
+                    {
+                        chunk_key: {
+                            **(status or {}),
+                            **_chunk_records_to_status(maybe_nodes, maybe_edges),
+                            "full_doc_id": chunk_dp.get("full_doc_id"),
+                            "duplicate_of": twin_key,
+                            "status": ChunkStatus.EXTRACTED,
+                            "updated_at": datetime.now().isoformat(),
+                        }
+                    }
+                )
+            return chunk_key, (maybe_nodes, maybe_edges)
+
+        # Register before extracting so concurrent twins wait for this result
+        future = asyncio.get_event_loop().create_future()
+        chunk_dedup.inflight[chunk_key] = future
+        chunk_dedup.add(chunk_key, signature)
+        try:
+            result = await _extract_single_content(
+                chunk_key,
+                chunk_dp,
+                status,
+                extra_status={"minhash": signature.tolist()},
+            )
+            future.set_result(result[1:])
+            return result[0], result[1]
+        except Exception:
+            chunk_dedup.remove([chunk_key])
+            future.set_result(None)
+            raise
+        finally:
+            chunk_dedup.inflight.pop(chunk_key, None)
+
+    async def _extract_single_content(
+        chunk_key: str,
+        chunk_dp: TextChunkSchema,
+        status: Union[dict, None],
+        extra_status: dict = None,
+    ):
+        nonlocal already_processed, already_entities, already_relations
         content = chunk_dp["content"]
+        llm_calls = 1
         # hint_prompt = entity_extract_prompt.format(**context_base, input_text=content)
         hint_prompt = entity_extract_prompt.format(
             **context_base, input_text="{input_text}"
@@ -399,12 +789,14 @@ async def extract_entities(
 
             history += pack_user_ass_to_openai_messages(continue_prompt, glean_result)
             final_result += glean_result
+            llm_calls += 1
             if now_glean_index == entity_extract_max_gleaning - 1:
                 break
 
             if_loop_result: str = await _user_llm_func_with_cache(
                 if_loop_prompt, history_messages=history
             )
+            llm_calls += 1
             if_loop_result = if_loop_result.strip().strip('"').strip("'").lower()
             if if_loop_result != "yes":
                 break
@@ -449,7 +841,21 @@ async def extract_entities(
             end="",
             flush=True,
         )
-        return dict(maybe_nodes), dict(maybe_edges)
+        if chunk_status is not None:
+            await chunk_status.upsert(
+                {
+                    chunk_key: {
+                        **(status or {}),
+                        **_chunk_records_to_status(maybe_nodes, maybe_edges),
+                        **(extra_status or {}),
+                        "full_doc_id": chunk_dp.get("full_doc_id"),
+                        "llm_calls": llm_calls,
+                        "status": ChunkStatus.EXTRACTED,
+                        "updated_at": datetime.now().isoformat(),
+                    }
+                }
+            )
+        return chunk_key, (dict(maybe_nodes), dict(maybe_edges)), llm_calls
 
     results = []
     for result in tqdm_async(
@@ -460,19 +866,157 @@ async def extract_entities(
     ):
         results.append(await result)
 
+    return dict(results)
+
+
+async def mark_chunks_merged(
+    chunk_status: BaseKVStorage, chunk_results: dict[str, tuple[dict, dict]]
+):
+    """Checkpoint chunks whose extraction results are merged into the graph"""
+    if chunk_status is None or not chunk_results:
+        return
+    now = datetime.now().isoformat()
+    statuses = await chunk_status.get_by_ids(list(chunk_results.keys()))
+    await chunk_status.upsert(
+        {
+            chunk_key: {
+                **(status or {}),
+                **_chunk_records_to_status(*records),
+                "status": ChunkStatus.MERGED,
+                "updated_at": now,
+            }
+            for (chunk_key, records), status in zip(chunk_results.items(), statuses)
+        }
+    )
+
+
+def _group_chunk_records(
+    chunk_results: dict[str, tuple[dict, dict]],
+) -> tuple[dict, dict]:
     maybe_nodes = defaultdict(list)
     maybe_edges = defaultdict(list)
-    for m_nodes, m_edges in results:
+    for m_nodes, m_edges in chunk_results.values():
         for k, v in m_nodes.items():
             maybe_nodes[k].extend(v)
         for k, v in m_edges.items():
             maybe_edges[tuple(sorted(k))].extend(v)
+    return maybe_nodes, maybe_edges
+
+
+async def replay_per_document_merges(
+    doc_results: list[dict[str, tuple[dict, dict]]],
+    knowledge_graph_inst: BaseGraphStorage,
+    entity_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    global_config: dict,
+) -> dict:
+    """Summary LLM calls and vector embeddings merging doc_results one document
+    at a time would take, call it before the batch is merged into the graph
+
+    Each pass rebuilds the descriptions and keywords of the entities and
+    relations of one document as the per-document merge does. A changed
+    description over the summary budget counts one summary call (none when
+    summaries are deferred), a changed row one embedding; storages that do not
+    skip unchanged rows (no upsert_stats) embed every row. No summaries are
+    generated, the replay carries the unsummarized descriptions forward.
+    """
+    summary_max_tokens = global_config["entity_summary_to_max_tokens"]
+    summarize = not global_config.get("defer_entity_summary")
+    stats = {"summaries": 0, "embeddings": 0}
+    stored = {}
+
+    async def merge_pass(key, records, vdb, lookup):
+        if key not in stored:
+            # The stored node or edge is only looked up on the first pass
+            current = await lookup()
+            stored[key] = current and (
+                current["description"],
+                split_string_by_multi_markers(
+                    current.get("keywords", ""), [GRAPH_FIELD_SEP]
+                ),
+            )
+        already_description, already_keywords = stored[key] or (None, [])
+        description = GRAPH_FIELD_SEP.join(
+            sorted(
+                set([dp["description"] for dp in records])
+                | ({already_description} if stored[key] else set())
+            )
+        )
+        keywords = sorted(
+            set([dp["keywords"] for dp in records if "keywords" in dp])
+            | set(already_keywords)
+        )
+        if description != already_description and summarize:
+            if await _count_tokens(description, global_config) >= summary_max_tokens:
+                stats["summaries"] += 1
+        if vdb is not None and (
+            (description, keywords) != stored[key] or not hasattr(vdb, "upsert_stats")
+        ):
+            stats["embeddings"] += 1
+        stored[key] = (description, keywords)
+
+    for chunk_results in doc_results:
+        maybe_nodes, maybe_edges = _group_chunk_records(chunk_results)
+        for name, records in maybe_nodes.items():
+            await merge_pass(
+                name,
+                records,
+                entity_vdb,
+                lambda: knowledge_graph_inst.get_node(name),
+            )
+        for (src_id, tgt_id), records in maybe_edges.items():
+            await merge_pass(
+                (src_id, tgt_id),
+                records,
+                relationships_vdb,
+                lambda: knowledge_graph_inst.get_edge(src_id, tgt_id),
+            )
+    return stats
+
+
+async def _upsert_vectors(
+    vdb: BaseVectorStorage, data: dict[str, dict], merge_stats: dict = None
+):
+    """Upsert data, counting the rows actually embedded in merge_stats"""
+    upsert_stats = getattr(vdb, "upsert_stats", None)
+    before = upsert_stats["upserted"] if upsert_stats else 0
+    await vdb.upsert(data)
+    if merge_stats is not None:
+        merge_stats["embeddings"] += (
+            upsert_stats["upserted"] - before if upsert_stats else len(data)
+        )
+
+
+async def merge_chunk_records(
+    chunk_results: dict[str, tuple[dict, dict]],
+    knowledge_graph_inst: BaseGraphStorage,
+    entity_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    global_config: dict,
+    pending_summaries: set = None,
+    merge_stats: dict = None,
+) -> Union[BaseGraphStorage, None]:
+    """Merge extracted nodes and edges into the graph and upsert their vectors
+
+    With defer_entity_summary, names of over-budget descriptions are added to
+    pending_summaries instead of being summarized inline, see compact_summaries.
+    Summary LLM calls and embedded vector rows are added to merge_stats
+    ("summaries", "embeddings") when given.
+    """
+    maybe_nodes, maybe_edges = _group_chunk_records(chunk_results)
     logger.info("Inserting entities into storage...")
     all_entities_data = []
     for result in tqdm_async(
         asyncio.as_completed(
             [
-                _merge_nodes_then_upsert(k, v, knowledge_graph_inst, global_config)
+                _merge_nodes_then_upsert(
+                    k,
+                    v,
+                    knowledge_graph_inst,
+                    global_config,
+                    pending_summaries,
+                    merge_stats,
+                )
                 for k, v in maybe_nodes.items()
             ]
         ),
@@ -488,7 +1032,13 @@ async def extract_entities(
         asyncio.as_completed(
             [
                 _merge_edges_then_upsert(
-                    k[0], k[1], v, knowledge_graph_inst, global_config
+                    k[0],
+                    k[1],
+                    v,
+                    knowledge_graph_inst,
+                    global_config,
+                    pending_summaries,
+                    merge_stats,
                 )
                 for k, v in maybe_edges.items()
             ]
@@ -518,7 +1068,7 @@ async def extract_entities(
             }
             for dp in all_entities_data
         }
-        await entity_vdb.upsert(data_for_vdb)
+        await _upsert_vectors(entity_vdb, data_for_vdb, merge_stats)
 
     if relationships_vdb is not None:
         data_for_vdb = {
@@ -535,11 +1085,128 @@ async def extract_entities(
             }
             for dp in all_relationships_data
         }
-        await relationships_vdb.upsert(data_for_vdb)
+        await _upsert_vectors(relationships_vdb, data_for_vdb, merge_stats)
 
     return knowledge_graph_inst
 
 
+async def _compact_single_summary(
+    name: Union[str, tuple[str, str]],
+    knowledge_graph_inst: BaseGraphStorage,
+    entity_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    global_config: dict,
+    pending_summaries: set,
+) -> bool:
+    is_entity = isinstance(name, str)
+    if is_entity:
+        data = await knowledge_graph_inst.get_node(name)
+    else:
+        data = await knowledge_graph_inst.get_edge(name[0], name[1])
+    if data is None:
+        return False
+
+    description = data["description"]
+    summary_name = name if is_entity else f"({name[0]}, {name[1]})"
+    summary = await _handle_entity_relation_summary(
+        summary_name, description, global_config
+    )
+    if summary == description:
+        return False
+
+    # A merge may have extended the description while the LLM was summarizing
+    if is_entity:
+        data = await knowledge_graph_inst.get_node(name)
+    else:
+        data = await knowledge_graph_inst.get_edge(name[0], name[1])
+    if data is None:
+        return False
+    if data["description"] != description:
+        pending_summaries.add(name)
+        return False
+
+    data = {
+        **data,
+        "description": summary,
+        "description_tokens": await _count_tokens(summary, global_config),
+    }
+    if is_entity:
+        await knowledge_graph_inst.upsert_node(name, node_data=data)
+        if entity_vdb is not None:
+            await entity_vdb.upsert(
+                {
+                    compute_mdhash_id(name, prefix="ent-"): {
+                        "content": name + summary,
+                        "entity_name": name,
+                    }
+                }
+            )
+    else:
+        await knowledge_graph_inst.upsert_edge(name[0], name[1], edge_data=data)
+        if relationships_vdb is not None:
+            await relationships_vdb.upsert(
+                {
+                    compute_mdhash_id(name[0] + name[1], prefix="rel-"): {
+                        "src_id": name[0],
+                        "tgt_id": name[1],
+                        "content": data["keywords"] + name[0] + name[1] + summary,
+                    }
+                }
+            )
+    return True
+
+
+async def compact_summaries(
+    pending_summaries: set,
+    knowledge_graph_inst: BaseGraphStorage,
+    entity_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    global_config: dict,
+) -> int:
+    """Summarize the descriptions queued by a deferred merge
+
+    Every entity or relation pending at the start is summarized at most once
+    per call, in concurrent batches of llm_model_max_async. Descriptions
+    changed by a concurrent merge are queued again for the next call.
+
+    Returns:
+        Number of descriptions replaced by their summary
+    """
+    names = list(pending_summaries)
+    pending_summaries.difference_update(names)
+    if not names:
+        return 0
+
+    batch_size = max(1, global_config["llm_model_max_async"])
+    summarized = 0
+    for i in range(0, len(names), batch_size):
+        batch = names[i : i + batch_size]
+        results = await asyncio.gather(
+            *[
+                _compact_single_summary(
+                    name,
+                    knowledge_graph_inst,
+                    entity_vdb,
+                    relationships_vdb,
+                    global_config,
+                    pending_summaries,
+                )
+                for name in batch
+            ],
+            return_exceptions=True,
+        )
+        for name, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to summarize {name}: {result}")
+                pending_summaries.add(name)
+            elif result:
+                summarized += 1
+    logger.info(
+        f"Summary compaction: {summarized} of {len(names)} pending descriptions summarized"
+    )
+    return summarized
+
+
 async def kg_query(
     query,
     knowledge_graph_inst: BaseGraphStorage,
@@ -554,7 +1221,11 @@ async def kg_query(
     use_model_func = global_config["llm_model_func"]
     args_hash = compute_args_hash(query_param.mode, query)
     cached_response, quantized, min_val, max_val = await handle_cache(
-        hashing_kv, args_hash, query, query_param.mode
+        hashing_kv,
+        args_hash,
+        query,
+        query_param.mode,
+        embedding_func=relationships_vdb.embedding_func,
     )
     if cached_response is not None:
         return cached_response
@@ -634,7 +1305,7 @@ async def kg_query(
 
     if query_param.only_need_context:
         return context
-    if context is None:
+    if not context:
         return PROMPTS["fail_response"]
     sys_prompt_temp = PROMPTS["rag_response"]
     sys_prompt = sys_prompt_temp.format(
@@ -682,82 +1353,244 @@ async def _build_query_context(
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
 ):
-    # ll_entities_context, ll_relations_context, ll_text_units_context = "", "", ""
-    # hl_entities_context, hl_relations_context, hl_text_units_context = "", "", ""
-
     ll_keywords, hl_keywords = query[0], query[1]
 
-    if query_param.mode == "local":
-        entities_context, relations_context, text_units_context = await _get_node_data(
-            ll_keywords,
-            knowledge_graph_inst,
-            entities_vdb,
-            text_chunks_db,
+    if query_param.max_token_for_context > 0:
+        # Candidates are only capped by the total budget, the allocator picks among them
+        total = query_param.max_token_for_context
+        candidate_param = replace(
             query_param,
+            max_token_for_text_unit=total,
+            max_token_for_global_context=total,
+            max_token_for_local_context=total,
         )
-    elif query_param.mode == "global":
-        entities_context, relations_context, text_units_context = await _get_edge_data(
-            hl_keywords,
-            knowledge_graph_inst,
-            relationships_vdb,
-            text_chunks_db,
-            query_param,
+    else:
+        candidate_param = query_param
+
+    if query_param.mode == "hybrid":
+        await prefetch_query_embeddings(
+            entities_vdb.embedding_func, [ll_keywords, hl_keywords]
         )
-    else:  # hybrid mode
-        (
-            ll_entities_context,
-            ll_relations_context,
-            ll_text_units_context,
-        ) = await _get_node_data(
-            ll_keywords,
-            knowledge_graph_inst,
-            entities_vdb,
-            text_chunks_db,
-            query_param,
+
+    contexts = []
+    if query_param.mode in ["local", "hybrid"]:
+        contexts.append(
+            await _get_node_data(
+                ll_keywords,
+                knowledge_graph_inst,
+                entities_vdb,
+                text_chunks_db,
+                candidate_param,
+            )
         )
-        (
-            hl_entities_context,
-            hl_relations_context,
-            hl_text_units_context,
-        ) = await _get_edge_data(
-            hl_keywords,
-            knowledge_graph_inst,
-            relationships_vdb,
-            text_chunks_db,
-            query_param,
+    if query_param.mode in ["global", "hybrid"]:
+        # High level results come first when both halves are combined
+        contexts.insert(
+            0,
+            await _get_edge_data(
+                hl_keywords,
+                knowledge_graph_inst,
+                relationships_vdb,
+                text_chunks_db,
+                candidate_param,
+            ),
         )
-        entities_context, relations_context, text_units_context = combine_contexts(
-            [hl_entities_context, ll_entities_context],
-            [hl_relations_context, ll_relations_context],
-            [hl_text_units_context, ll_text_units_context],
+
+    if query_param.max_token_for_context > 0:
+        context, allocation = allocate_context_budget(
+            contexts, query_param.max_token_for_context
         )
+        logger.info(f"Context budget allocation: {json.dumps(allocation)}")
+    else:
+        context = QueryContext()
+        for part in contexts:
+            context = context.merge(part)
+    return _render_query_context(context)
+
+
+def _render_query_context(context: QueryContext) -> str:
+    if context.is_empty():
+        return ""
+    entities_section_list = [["id", "entity", "type", "description", "rank"]]
+    for i, n in enumerate(context.entities):
+        entities_section_list.append(
+            [i, n.entity_name, n.entity_type, n.description, n.rank]
+        )
+
+    relations_section_list = [
+        [
+            "id",
+            "source",
+            "target",
+            "description",
+            "keywords",
+            "weight",
+            "rank",
+            "created_at",
+        ]
+    ]
+    for i, e in enumerate(context.relations):
+        created_at = e.created_at if e.created_at is not None else "UNKNOWN"
+        # Convert timestamp to readable format
+        if isinstance(created_at, (int, float)):
+            created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created_at))
+        relations_section_list.append(
+            [
+                i,
+                e.src_id,
+                e.tgt_id,
+                e.description,
+                e.keywords,
+                e.weight,
+                e.rank,
+                created_at,
+            ]
+        )
+
+    text_units_section_list = [["id", "content"]]
+    for i, t in enumerate(context.sources):
+        text_units_section_list.append([i, t.content])
+
     return f"""
 -----Entities-----
 ```csv
-{entities_context}
+{list_of_list_to_csv(entities_section_list)}
 ```
 -----Relationships-----
 ```csv
-{relations_context}
+{list_of_list_to_csv(relations_section_list)}
 ```
 -----Sources-----
 ```csv
-{text_units_context}
+{list_of_list_to_csv(text_units_section_list)}
 ```
 """
 
 
+def _to_query_context(
+    node_datas: list[dict], edge_datas: list[dict], text_units: list[dict]
+) -> QueryContext:
+    entities = [
+        EntityContext(
+            entity_name=n["entity_name"],
+            entity_type=n.get("entity_type", "UNKNOWN"),
+            description=n.get("description", "UNKNOWN"),
+            rank=n["rank"],
+            description_tokens=n.get("description_tokens"),
+        )
+        for n in node_datas
+    ]
+    relations = []
+    for e in edge_datas:
+        # Relations found from entities carry "src_tgt", the ones from the vdb src_id/tgt_id
+        src_id, tgt_id = e["src_tgt"] if "src_tgt" in e else (e["src_id"], e["tgt_id"])
+        relations.append(
+            RelationContext(
+                src_id=src_id,
+                tgt_id=tgt_id,
+                description=e["description"],
+                keywords=e["keywords"],
+                weight=e["weight"],
+                rank=e["rank"],
+                created_at=e.get("created_at"),
+                description_tokens=e.get("description_tokens"),
+            )
+        )
+    sources = [
+        SourceContext(
+            id=t.get("id") or compute_mdhash_id(t["content"], prefix="chunk-"),
+            content=t["content"],
+            tokens=t.get("tokens"),
+        )
+        for t in text_units
+    ]
+    return QueryContext(entities=entities, relations=relations, sources=sources)
+
+
+def _record_tokens(record) -> int:
+    if isinstance(record, SourceContext):
+        count = record.tokens
+        text = record.content
+    else:
+        count = record.description_tokens
+        text = record.description
+    if count is None:
+        count = len(encode_string_by_tiktoken(text))
+    return max(1, count)
+
+
+def allocate_context_budget(
+    contexts: list[QueryContext], max_token_size: int
+) -> tuple[QueryContext, dict]:
+    """Fill one token budget across entities, relations and sources
+
+    Args:
+        contexts: contexts whose records are ordered by relevance, e.g. from the
+            low and high level keywords
+        max_token_size: total tokens for all selected records
+
+    A record's relevance is the reciprocal of its position in its list, summed
+    over the contexts it appears in. Records are taken greedily by relevance
+    per token while they fit the budget, then kept in relevance order per kind.
+
+    Returns:
+        The selected context, and the allocation report
+    """
+    kinds = ["entities", "relations", "sources"]
+    merged = {}
+    for context in contexts:
+        for kind in kinds:
+            for position, record in enumerate(getattr(context, kind)):
+                key = (kind, record.id)
+                if key in merged:
+                    merged[key]["score"] += 1 / (1 + position)
+                else:
+                    merged[key] = {
+                        "kind": kind,
+                        "record": record,
+                        "score": 1 / (1 + position),
+                        "tokens": _record_tokens(record),
+                    }
+
+    used = 0
+    selected = []
+    for entry in sorted(
+        merged.values(), key=lambda x: x["score"] / x["tokens"], reverse=True
+    ):
+        if used + entry["tokens"] > max_token_size:
+            continue
+        used += entry["tokens"]
+        selected.append(entry)
+
+    allocation = {"budget": max_token_size, "used": used}
+    result = QueryContext()
+    for kind in kinds:
+        kind_selected = sorted(
+            [e for e in selected if e["kind"] == kind],
+            key=lambda x: x["score"],
+            reverse=True,
+        )
+        setattr(result, kind, [e["record"] for e in kind_selected])
+        allocation[kind] = {
+            "candidates": sum(1 for e in merged.values() if e["kind"] == kind),
+            "selected": len(kind_selected),
+            "tokens": sum(e["tokens"] for e in kind_selected),
+        }
+    return result, allocation
+
+
 async def _get_node_data(
     query,
     knowledge_graph_inst: BaseGraphStorage,
     entities_vdb: BaseVectorStorage,
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
-):
+) -> QueryContext:
+    """Entities similar to the query with their related relations and text units"""
     # get similar entities
     results = await entities_vdb.query(query, top_k=query_param.top_k)
     if not len(results):
-        return "", "", ""
+        return QueryContext()
     # get entity information
     node_datas = await asyncio.gather(
         *[knowledge_graph_inst.get_node(r["entity_name"]) for r in results]
@@ -785,57 +1618,7 @@ async def _get_node_data(
     logger.info(
         f"Local query uses {len(node_datas)} entites, {len(use_relations)} relations, {len(use_text_units)} text units"
     )
-
-    # build prompt
-    entites_section_list = [["id", "entity", "type", "description", "rank"]]
-    for i, n in enumerate(node_datas):
-        entites_section_list.append(
-            [
-                i,
-                n["entity_name"],
-                n.get("entity_type", "UNKNOWN"),
-                n.get("description", "UNKNOWN"),
-                n["rank"],
-            ]
-        )
-    entities_context = list_of_list_to_csv(entites_section_list)
-
-    relations_section_list = [
-        [
-            "id",
-            "source",
-            "target",
-            "description",
-            "keywords",
-            "weight",
-            "rank",
-            "created_at",
-        ]
-    ]
-    for i, e in enumerate(use_relations):
-        created_at = e.get("created_at", "UNKNOWN")
-        # Convert timestamp to readable format
-        if isinstance(created_at, (int, float)):
-            created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created_at))
-        relations_section_list.append(
-            [
-                i,
-                e["src_tgt"][0],
-                e["src_tgt"][1],
-                e["description"],
-                e["keywords"],
-                e["weight"],
-                e["rank"],
-                created_at,
-            ]
-        )
-    relations_context = list_of_list_to_csv(relations_section_list)
-
-    text_units_section_list = [["id", "content"]]
-    for i, t in enumerate(use_text_units):
-        text_units_section_list.append([i, t["content"]])
-    text_units_context = list_of_list_to_csv(text_units_section_list)
-    return entities_context, relations_context, text_units_context
+    return _to_query_context(node_datas, use_relations, use_text_units)
 
 
 async def _find_most_related_text_unit_from_entities(
@@ -844,10 +1627,9 @@ async def _find_most_related_text_unit_from_entities(
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     knowledge_graph_inst: BaseGraphStorage,
 ):
-    text_units = [
-        split_string_by_multi_markers(dp["source_id"], [GRAPH_FIELD_SEP])
-        for dp in node_datas
-    ]
+    text_units = await knowledge_graph_inst.get_nodes_chunk_ids(
+        [dp["entity_name"] for dp in node_datas]
+    )
     edges = await asyncio.gather(
         *[knowledge_graph_inst.get_node_edges(dp["entity_name"]) for dp in node_datas]
     )
@@ -858,34 +1640,36 @@ async def _find_most_related_text_unit_from_entities(
         all_one_hop_nodes.update([e[1] for e in this_edges])
 
     all_one_hop_nodes = list(all_one_hop_nodes)
-    all_one_hop_nodes_data = await asyncio.gather(
-        *[knowledge_graph_inst.get_node(e) for e in all_one_hop_nodes]
-    )
-
-    # Add null check for node data
     all_one_hop_text_units_lookup = {
-        k: set(split_string_by_multi_markers(v["source_id"], [GRAPH_FIELD_SEP]))
-        for k, v in zip(all_one_hop_nodes, all_one_hop_nodes_data)
-        if v is not None and "source_id" in v  # Add source_id check
+        k: set(v)
+        for k, v in zip(
+            all_one_hop_nodes,
+            await knowledge_graph_inst.get_nodes_chunk_ids(all_one_hop_nodes),
+        )
+        if v
     }
 
+    # Fetch every candidate chunk in one round trip
+    chunk_ids = list(dict.fromkeys(c_id for units in text_units for c_id in units))
+    chunk_rows = await text_chunks_db.get_by_ids(chunk_ids) if chunk_ids else []
+    chunk_datas = dict(zip(chunk_ids, chunk_rows or []))
+
     all_text_units_lookup = {}
     for index, (this_text_units, this_edges) in enumerate(zip(text_units, edges)):
         for c_id in this_text_units:
             if c_id not in all_text_units_lookup:
                 all_text_units_lookup[c_id] = {
-                    "data": await text_chunks_db.get_by_id(c_id),
+                    "data": chunk_datas.get(c_id),
                     "order": index,
                     "relation_counts": 0,
                 }
 
-            if this_edges:
-                for e in this_edges:
-                    if (
-                        e[1] in all_one_hop_text_units_lookup
-                        and c_id in all_one_hop_text_units_lookup[e[1]]
-                    ):
-                        all_text_units_lookup[c_id]["relation_counts"] += 1
+        # Count, per chunk, the one-hop neighbours extracted from it too
+        this_text_units = set(this_text_units)
+        for e in this_edges or ():
+            shared = this_text_units & all_one_hop_text_units_lookup.get(e[1], set())
+            for c_id in shared:
+                all_text_units_lookup[c_id]["relation_counts"] += 1
 
     # Filter out None values and ensure data has content
     all_text_units = [
@@ -905,10 +1689,11 @@ async def _find_most_related_text_unit_from_entities(
     all_text_units = truncate_list_by_token_size(
         all_text_units,
         key=lambda x: x["data"]["content"],
+        token_count=lambda x: x["data"].get("tokens"),
         max_token_size=query_param.max_token_for_text_unit,
     )
 
-    all_text_units = [t["data"] for t in all_text_units]
+    all_text_units = [{"id": t["id"], **t["data"]} for t in all_text_units]
     return all_text_units
 
 
@@ -947,6 +1732,7 @@ async def _find_most_related_edges_from_entities(
     all_edges_data = truncate_list_by_token_size(
         all_edges_data,
         key=lambda x: x["description"],
+        token_count=lambda x: x.get("description_tokens"),
         max_token_size=query_param.max_token_for_global_context,
     )
     return all_edges_data
@@ -958,11 +1744,12 @@ async def _get_edge_data(
     relationships_vdb: BaseVectorStorage,
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
-):
+) -> QueryContext:
+    """Relations similar to the keywords with their related entities and text units"""
     results = await relationships_vdb.query(keywords, top_k=query_param.top_k)
 
     if not len(results):
-        return "", "", ""
+        return QueryContext()
 
     edge_datas = await asyncio.gather(
         *[knowledge_graph_inst.get_edge(r["src_id"], r["tgt_id"]) for r in results]
@@ -990,6 +1777,7 @@ async def _get_edge_data(
     edge_datas = truncate_list_by_token_size(
         edge_datas,
         key=lambda x: x["description"],
+        token_count=lambda x: x.get("description_tokens"),
         max_token_size=query_param.max_token_for_global_context,
     )
 
@@ -1002,56 +1790,7 @@ async def _get_edge_data(
     logger.info(
         f"Global query uses {len(use_entities)} entites, {len(edge_datas)} relations, {len(use_text_units)} text units"
     )
-
-    relations_section_list = [
-        [
-            "id",
-            "source",
-            "target",
-            "description",
-            "keywords",
-            "weight",
-            "rank",
-            "created_at",
-        ]
-    ]
-    for i, e in enumerate(edge_datas):
-        created_at = e.get("created_at", "Unknown")
-        # Convert timestamp to readable format
-        if isinstance(created_at, (int, float)):
-            created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created_at))
-        relations_section_list.append(
-            [
-                i,
-                e["src_id"],
-                e["tgt_id"],
-                e["description"],
-                e["keywords"],
-                e["weight"],
-                e["rank"],
-                created_at,
-            ]
-        )
-    relations_context = list_of_list_to_csv(relations_section_list)
-
-    entites_section_list = [["id", "entity", "type", "description", "rank"]]
-    for i, n in enumerate(use_entities):
-        entites_section_list.append(
-            [
-                i,
-                n["entity_name"],
-                n.get("entity_type", "UNKNOWN"),
-                n.get("description", "UNKNOWN"),
-                n["rank"],
-            ]
-        )
-    entities_context = list_of_list_to_csv(entites_section_list)
-
-    text_units_section_list = [["id", "content"]]
-    for i, t in enumerate(use_text_units):
-        text_units_section_list.append([i, t["content"]])
-    text_units_context = list_of_list_to_csv(text_units_section_list)
-    return entities_context, relations_context, text_units_context
+    return _to_query_context(use_entities, edge_datas, use_text_units)
 
 
 async def _find_most_related_entities_from_relationships(
@@ -1085,6 +1824,7 @@ async def _find_most_related_entities_from_relationships(
     node_datas = truncate_list_by_token_size(
         node_datas,
         key=lambda x: x["description"],
+        token_count=lambda x: x.get("description_tokens"),
         max_token_size=query_param.max_token_for_local_context,
     )
 
@@ -1097,16 +1837,19 @@ async def _find_related_text_unit_from_relationships(
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     knowledge_graph_inst: BaseGraphStorage,
 ):
-    text_units = [
-        split_string_by_multi_markers(dp["source_id"], [GRAPH_FIELD_SEP])
-        for dp in edge_datas
-    ]
+    text_units = await knowledge_graph_inst.get_edges_chunk_ids(
+        [(dp["src_id"], dp["tgt_id"]) for dp in edge_datas]
+    )
+    # Fetch every candidate chunk in one round trip
+    chunk_ids = list(dict.fromkeys(c_id for units in text_units for c_id in units))
+    chunk_rows = await text_chunks_db.get_by_ids(chunk_ids) if chunk_ids else []
+    chunk_datas = dict(zip(chunk_ids, chunk_rows or []))
     all_text_units_lookup = {}
 
     for index, unit_list in enumerate(text_units):
         for c_id in unit_list:
             if c_id not in all_text_units_lookup:
-                chunk_data = await text_chunks_db.get_by_id(c_id)
+                chunk_data = chunk_datas.get(c_id)
                 # Only store valid data
                 if chunk_data is not None and "content" in chunk_data:
                     all_text_units_lookup[c_id] = {
@@ -1133,33 +1876,17 @@ async def _find_related_text_unit_from_relationships(
     truncated_text_units = truncate_list_by_token_size(
         valid_text_units,
         key=lambda x: x["data"]["content"],
+        token_count=lambda x: x["data"].get("tokens"),
         max_token_size=query_param.max_token_for_text_unit,
     )
 
-    all_text_units: list[TextChunkSchema] = [t["data"] for t in truncated_text_units]
+    all_text_units: list[TextChunkSchema] = [
+        {"id": t["id"], **t["data"]} for t in truncated_text_units
+    ]
 
     return all_text_units
 
 
-def combine_contexts(entities, relationships, sources):
-    # Function to extract entities, relationships, and sources from context strings
-    hl_entities, ll_entities = entities[0], entities[1]
-    hl_relationships, ll_relationships = relationships[0], relationships[1]
-    hl_sources, ll_sources = sources[0], sources[1]
-    # Combine and deduplicate the entities
-    combined_entities = process_combine_contexts(hl_entities, ll_entities)
-
-    # Combine and deduplicate the relationships
-    combined_relationships = process_combine_contexts(
-        hl_relationships, ll_relationships
-    )
-
-    # Combine and deduplicate the sources
-    combined_sources = process_combine_contexts(hl_sources, ll_sources)
-
-    return combined_entities, combined_relationships, combined_sources
-
-
 async def naive_query(
     query,
     chunks_vdb: BaseVectorStorage,
@@ -1196,6 +1923,7 @@ async def naive_query(
     maybe_trun_chunks = truncate_list_by_token_size(
         valid_chunks,
         key=lambda x: x["content"],
+        token_count=lambda x: x.get("tokens"),
         max_token_size=query_param.max_token_for_text_unit,
     )
 
@@ -1251,6 +1979,92 @@ async def naive_query(
     return response
 
 
+class _GraphReadCache:
+    """Per-request memo of graph reads, shared by speculative and real retrieval.
+
+    Each read is started once as a task; later callers with the same arguments
+    await the same task. Other attributes are passed through to the graph.
+    """
+
+    _CACHED_READS = (
+        "get_node",
+        "node_degree",
+        "get_node_edges",
+        "get_edge",
+        "edge_degree",
+    )
+
+    def __init__(self, graph: BaseGraphStorage):
+        self._graph = graph
+        self._reads: dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._graph, name)
+        if name not in self._CACHED_READS:
+            return attr
+
+        def read(*args):
+            task = self._reads.get((name, args))
+            if task is None:
+                task = asyncio.ensure_future(attr(*args))
+                self._reads[(name, args)] = task
+            else:
+                self.hits += 1
+            return task
+
+        return read
+
+    def close(self) -> int:
+        """Cancel speculative reads nobody awaited, return how many were dropped"""
+        pending = [task for task in self._reads.values() if not task.done()]
+        for task in pending:
+            task.cancel()
+        return len(pending)
+
+
+async def _speculate_graph_reads(
+    query: str,
+    graph: _GraphReadCache,
+    entities_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    top_k: int,
+):
+    """Warm graph reads for entities and relations close to the raw query"""
+    try:
+        entities, relations = await asyncio.gather(
+            entities_vdb.query(query, top_k=top_k),
+            relationships_vdb.query(query, top_k=top_k),
+        )
+        names = [r["entity_name"] for r in entities]
+        edges = [(r["src_id"], r["tgt_id"]) for r in relations]
+
+        # Shield the shared reads so cancelling speculation never cancels a read
+        # that keyword-driven retrieval is also waiting on
+        node_edges = await asyncio.gather(
+            *[asyncio.shield(graph.get_node_edges(name)) for name in names],
+            *[asyncio.shield(graph.get_node(name)) for name in names],
+            *[asyncio.shield(graph.node_degree(name)) for name in names],
+            *[asyncio.shield(graph.get_edge(*edge)) for edge in edges],
+            *[asyncio.shield(graph.edge_degree(*edge)) for edge in edges],
+            return_exceptions=True,
+        )
+        neighbour_edges = {
+            tuple(sorted(e))
+            for this_edges in node_edges[: len(names)]
+            if isinstance(this_edges, list)
+            for e in this_edges
+        }
+        await asyncio.gather(
+            *[asyncio.shield(graph.get_edge(*edge)) for edge in neighbour_edges],
+            *[asyncio.shield(graph.edge_degree(*edge)) for edge in neighbour_edges],
+            return_exceptions=True,
+        )
+    except Exception as e:
+        # Speculation is best effort, keyword-driven retrieval does the real work
+        logger.debug(f"Speculative retrieval failed: {e}")
+
+
 async def mix_kg_vector_query(
     query,
     knowledge_graph_inst: BaseGraphStorage,
@@ -1274,12 +2088,25 @@ async def mix_kg_vector_query(
     use_model_func = global_config["llm_model_func"]
     args_hash = compute_args_hash("mix", query)
     cached_response, quantized, min_val, max_val = await handle_cache(
-        hashing_kv, args_hash, query, "mix"
+        hashing_kv, args_hash, query, "mix", embedding_func=chunks_vdb.embedding_func
     )
     if cached_response is not None:
         return cached_response
 
     # 2. Execute knowledge graph and vector searches in parallel
+    graph = _GraphReadCache(knowledge_graph_inst)
+    speculation = None
+    if query_param.speculative_retrieval:
+        speculation = asyncio.ensure_future(
+            _speculate_graph_reads(
+                query, graph, entities_vdb, relationships_vdb, query_param.top_k
+            )
+        )
+
+    # Set once the raw query is embedded together with the keywords, the
+    # vector search waits for it instead of embedding the query on its own
+    query_embedded = asyncio.Event()
+
     async def get_kg_context():
         try:
             # Reuse keyword extraction logic from kg_query
@@ -1333,10 +2160,16 @@ async def mix_kg_vector_query(
             else:
                 query_param.mode = "hybrid"
 
+            # One embedding call for the raw query and both keyword strings
+            await prefetch_query_embeddings(
+                entities_vdb.embedding_func, [query, ll_keywords_str, hl_keywords_str]
+            )
+            query_embedded.set()
+
             # Build knowledge graph context
             context = await _build_query_context(
                 [ll_keywords_str, hl_keywords_str],
-                knowledge_graph_inst,
+                graph,
                 entities_vdb,
                 relationships_vdb,
                 text_chunks_db,
@@ -1348,12 +2181,23 @@ async def mix_kg_vector_query(
         except Exception as e:
             logger.error(f"Error in get_kg_context: {str(e)}")
             return None
+        finally:
+            query_embedded.set()
+            if speculation is not None:
+                speculation.cancel()
+                dropped = graph.close()
+                logger.debug(
+                    f"Speculative retrieval: {graph.hits} graph reads reused, {dropped} dropped"
+                )
 
     async def get_vector_context():
         # Reuse vector search logic from naive_query
         try:
             # Reduce top_k for vector search in hybrid mode since we have structured information from KG
             mix_topk = min(10, query_param.top_k)
+            # Speculation embeds the query right away, nothing to batch with
+            if speculation is None:
+                await query_embedded.wait()
             results = await chunks_vdb.query(query, top_k=mix_topk)
             if not results:
                 return None
@@ -1367,6 +2211,7 @@ async def mix_kg_vector_query(
                     # Merge chunk content and time metadata
                     chunk_with_time = {
                         "content": chunk["content"],
+                        "tokens": chunk.get("tokens"),
                         "created_at": result.get("created_at", None),
                     }
                     valid_chunks.append(chunk_with_time)
@@ -1377,6 +2222,7 @@ async def mix_kg_vector_query(
             maybe_trun_chunks = truncate_list_by_token_size(
                 valid_chunks,
                 key=lambda x: x["content"],
+                token_count=lambda x: x.get("tokens"),
                 max_token_size=query_param.max_token_for_text_unit,
             )
 
@@ -1402,7 +2248,7 @@ async def mix_kg_vector_query(
     )
 
     # 4. Merge contexts
-    if kg_context is None and vector_context is None:
+    if not kg_context and not vector_context:
         return PROMPTS["fail_response"]
 
     if query_param.only_need_context:
@@ -1,9 +1,11 @@
 import asyncio
 import html
+import json
 import os
+from collections import OrderedDict
 from tqdm.asyncio import tqdm as tqdm_async
 from dataclasses import dataclass
-from typing import Any, Union, cast, Dict
+from typing import Any, Optional, Union, cast, Dict
 import networkx as nx
 import numpy as np
 from nano_vectordb import NanoVectorDB
@@ -14,7 +16,9 @@ from .utils import (
     load_json,
     write_json,
     compute_mdhash_id,
+    split_string_by_multi_markers,
 )
+from .prompt import GRAPH_FIELD_SEP
 
 from .base import (
     BaseGraphStorage,
@@ -97,6 +101,202 @@ class JsonKVStorage(BaseKVStorage):
             logger.info(f"Successfully deleted {len(ids)} items from {self.namespace}")
 
 
+@dataclass
+class JsonChunkStatusStorage(JsonKVStorage):
+    """JSON implementation of chunk extraction status storage
+
+    Unlike JsonKVStorage, upsert overwrites existing records so a chunk can move
+    from pending to extracted to merged.
+    """
+
+    async def upsert(self, data: dict[str, dict]):
+        self._data.update(data)
+        return data
+
+
+@dataclass
+class JsonLLMCacheStorage(JsonKVStorage):
+    """JSON-backed LLM response cache with per-entry access and bounded size.
+
+    The on-disk layout stays ``{mode: {args_hash: entry}}`` so existing cache
+    files keep loading, but entries are read and written individually by
+    ``(mode, args_hash)`` and evicted once the configured budget is exceeded.
+    """
+
+    def __post_init__(self):
+        super().__post_init__()
+        config = self.global_config.get("llm_cache_config") or {}
+        self._max_entries = config.get("max_entries", 0) or 0
+        self._max_bytes = config.get("max_bytes", 0) or 0
+        self._ttl = config.get("ttl_seconds") or None
+        self._policy = config.get("eviction_policy", "lru")
+        if self._policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown LLM cache eviction policy {self._policy}")
+
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        self._sizes: dict[tuple[str, str], int] = {}
+        self._total_bytes = 0
+        self._dirty = False
+
+        # Access order, least recently used first
+        self._order: OrderedDict[tuple[str, str], None] = OrderedDict()
+        entries = [
+            (entry.get("accessed_at", 0), mode, args_hash)
+            for mode, mode_cache in self._data.items()
+            if isinstance(mode_cache, dict)
+            for args_hash, entry in mode_cache.items()
+        ]
+        now = time.time()
+        for _, mode, args_hash in sorted(entries, key=lambda x: x[0]):
+            entry = self._data[mode][args_hash]
+            entry.setdefault("created_at", now)
+            entry.setdefault("accessed_at", now)
+            entry.setdefault("hits", 0)
+            self._track(mode, args_hash, entry)
+        self._purge_expired()
+        self._evict()
+
+    @staticmethod
+    def _entry_size(entry: dict) -> int:
+        return len(json.dumps(entry, ensure_ascii=False, default=str).encode("utf-8"))
+
+    def _track(self, mode: str, args_hash: str, entry: dict):
+        key = (mode, args_hash)
+        size = self._entry_size(entry)
+        self._total_bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+        self._order[key] = None
+        self._order.move_to_end(key)
+
+    def _remove(self, mode: str, args_hash: str):
+        key = (mode, args_hash)
+        self._total_bytes -= self._sizes.pop(key, 0)
+        self._order.pop(key, None)
+        mode_cache = self._data.get(mode)
+        if mode_cache is not None:
+            mode_cache.pop(args_hash, None)
+            if not mode_cache:
+                del self._data[mode]
+        self._dirty = True
+
+    def _is_expired(self, entry: dict, now: float) -> bool:
+        return self._ttl is not None and now - entry["created_at"] > self._ttl
+
+    def _purge_expired(self):
+        if self._ttl is None:
+            return
+        now = time.time()
+        expired = [
+            (mode, args_hash)
+            for mode, args_hash in self._order
+            if self._is_expired(self._data[mode][args_hash], now)
+        ]
+        for mode, args_hash in expired:
+            self._remove(mode, args_hash)
+        self._stats["expirations"] += len(expired)
+
+    def _over_budget(self, ratio: float = 1.0) -> bool:
+        return bool(
+            (self._max_entries and len(self._order) > self._max_entries * ratio)
+            or (self._max_bytes and self._total_bytes > self._max_bytes * ratio)
+        )
+
+    def _evict(self):
+        if not self._over_budget():
+            return
+        if self._policy == "lru":
+            # The least recently used entry is always at the front
+            while self._over_budget():
+                mode, args_hash = next(iter(self._order))
+                self._remove(mode, args_hash)
+                self._stats["evictions"] += 1
+            return
+        # LFU needs a sort, so free some headroom to amortize it over many writes
+        victims = sorted(
+            self._order,
+            key=lambda k: (
+                self._data[k[0]][k[1]]["hits"],
+                self._data[k[0]][k[1]]["accessed_at"],
+            ),
+        )
+        for mode, args_hash in victims:
+            if not self._over_budget(ratio=0.9):
+                break
+            self._remove(mode, args_hash)
+            self._stats["evictions"] += 1
+
+    async def get_by_id(self, id):
+        """Return the whole cache of a mode, used by the similarity lookup"""
+        self._purge_expired()
+        return self._data.get(id, None)
+
+    async def get_by_mode_and_id(self, mode: str, id: str) -> Union[dict, None]:
+        """Return ``{id: entry}`` for a single cached response, or None on a miss"""
+        entry = self._data.get(mode, {}).get(id)
+        now = time.time()
+        if entry is not None and self._is_expired(entry, now):
+            self._remove(mode, id)
+            self._stats["expirations"] += 1
+            entry = None
+        if entry is None:
+            self._stats["misses"] += 1
+            return None
+        self._stats["hits"] += 1
+        entry["accessed_at"] = now
+        entry["hits"] += 1
+        self._order.move_to_end((mode, id))
+        self._dirty = True
+        return {id: entry}
+
+    async def upsert(self, data: dict[str, dict]):
+        """Insert or replace cache entries, given as ``{mode: {args_hash: entry}}``"""
+        now = time.time()
+        for mode, items in data.items():
+            mode_cache = self._data.setdefault(mode, {})
+            for args_hash, entry in items.items():
+                entry = dict(entry)
+                entry.setdefault("created_at", now)
+                entry["accessed_at"] = now
+                entry.setdefault("hits", 0)
+                mode_cache[args_hash] = entry
+                self._track(mode, args_hash, entry)
+        self._dirty = True
+        self._evict()
+        return data
+
+    async def drop(self):
+        self._data = {}
+        self._order.clear()
+        self._sizes.clear()
+        self._total_bytes = 0
+        self._dirty = True
+
+    async def delete(self, ids: list[str]):
+        """Delete the whole cache of the given modes"""
+        for mode in ids:
+            for args_hash in list(self._data.get(mode, {})):
+                self._remove(mode, args_hash)
+        await self.index_done_callback()
+
+    def cache_stats(self) -> dict:
+        """Hit/miss/eviction counters and current size of the cache"""
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+            "entries": len(self._order),
+            "bytes": self._total_bytes,
+        }
+
+    async def index_done_callback(self):
+        self._purge_expired()
+        if not self._dirty:
+            return
+        write_json(self._data, self._file_name)
+        self._dirty = False
+        logger.debug(f"LLM cache stats: {self.cache_stats()}")
+
+
 @dataclass
 class NanoVectorDBStorage(BaseVectorStorage):
     cosine_better_than_threshold: float = 0.2
@@ -112,6 +312,19 @@ class NanoVectorDBStorage(BaseVectorStorage):
         self.cosine_better_than_threshold = self.global_config.get(
             "cosine_better_than_threshold", self.cosine_better_than_threshold
         )
+        # Hash of the embedded content and meta fields per id, unchanged rows are not re-embedded
+        self._content_hashes = {
+            dp["__id__"]: dp["__content_hash__"]
+            for dp in self.client_storage["data"]
+            if "__content_hash__" in dp
+        }
+        self.upsert_stats = {"upserted": 0, "skipped": 0}
+
+    def _content_hash(self, value: dict) -> str:
+        meta = {k: v for k, v in value.items() if k in self.meta_fields}
+        return compute_mdhash_id(
+            value["content"] + json.dumps(meta, sort_keys=True, ensure_ascii=False)
+        )
 
     async def upsert(self, data: dict[str, dict]):
         logger.info(f"Inserting {len(data)} vectors to {self.namespace}")
@@ -119,11 +332,29 @@ class NanoVectorDBStorage(BaseVectorStorage):
             logger.warning("You insert an empty data to vector DB")
             return []
 
+        hashes = {k: self._content_hash(v) for k, v in data.items()}
+        changed = {
+            k: v for k, v in data.items() if self._content_hashes.get(k) != hashes[k]
+        }
+        skipped = len(data) - len(changed)
+        self.upsert_stats["upserted"] += len(changed)
+        self.upsert_stats["skipped"] += skipped
+        if skipped:
+            total = self.upsert_stats["upserted"] + self.upsert_stats["skipped"]
+            logger.info(
+                f"Skipped {skipped}/{len(data)} unchanged vectors in {self.namespace}, "
+                f"skip ratio {self.upsert_stats['skipped'] / total:.2%} overall"
+            )
+        if not changed:
+            return {"update": [], "insert": []}
+        data = changed
+
         current_time = time.time()
         list_data = [
             {
                 "__id__": k,
                 "__created_at__": current_time,
+                "__content_hash__": hashes[k],
                 **{k1: v1 for k1, v1 in v.items() if k1 in self.meta_fields},
             }
             for k, v in data.items()
@@ -150,6 +381,8 @@ class NanoVectorDBStorage(BaseVectorStorage):
             for i, d in enumerate(list_data):
                 d["__vector__"] = embeddings[i]
             results = self._client.upsert(datas=list_data)
+            for d in list_data:
+                self._content_hashes[d["__id__"]] = d["__content_hash__"]
             return results
         else:
             # sometimes the embedding is not returned correctly. just log it.
@@ -188,6 +421,8 @@ class NanoVectorDBStorage(BaseVectorStorage):
         """
         try:
             self._client.delete(ids)
+            for id in ids:
+                self._content_hashes.pop(id, None)
             logger.info(
                 f"Successfully deleted {len(ids)} vectors from {self.namespace}"
             )
@@ -233,6 +468,74 @@ class NanoVectorDBStorage(BaseVectorStorage):
         self._client.save()
 
 
+class ChunkAdjacency:
+    """Bipartite map between graph elements (node ids or edge tuples) and chunk ids.
+
+    Chunk ids are interned to integers so each element keeps a small ordered
+    set of ints and each chunk keeps the set of elements extracted from it.
+    The map is rebuilt from source_id when the graph is loaded and updated on
+    every upsert/delete, so queries never re-parse source_id strings. A chunk
+    id is released once no element references it, its int is reused.
+    """
+
+    def __init__(self):
+        self._chunk_index: dict[str, int] = {}
+        self._chunk_ids: list[Optional[str]] = []
+        self._free: list[int] = []
+        self._element_chunks: dict[Any, dict[int, None]] = {}
+        self._chunk_elements: dict[int, set] = {}
+
+    def _intern(self, chunk_id: str) -> int:
+        idx = self._chunk_index.get(chunk_id)
+        if idx is None:
+            if self._free:
+                idx = self._free.pop()
+                self._chunk_ids[idx] = chunk_id
+            else:
+                idx = len(self._chunk_ids)
+                self._chunk_ids.append(chunk_id)
+            self._chunk_index[chunk_id] = idx
+        return idx
+
+    def _release(self, idx: int):
+        del self._chunk_elements[idx]
+        del self._chunk_index[self._chunk_ids[idx]]
+        self._chunk_ids[idx] = None
+        self._free.append(idx)
+
+    def set(self, element: Any, source_id: str):
+        """Replace the chunks of element with the ones listed in source_id"""
+        self.remove(element)
+        if not source_id:
+            return
+        chunks = dict.fromkeys(
+            self._intern(c_id)
+            for c_id in split_string_by_multi_markers(source_id, [GRAPH_FIELD_SEP])
+        )
+        self._element_chunks[element] = chunks
+        for idx in chunks:
+            self._chunk_elements.setdefault(idx, set()).add(element)
+
+    def remove(self, element: Any):
+        for idx in self._element_chunks.pop(element, ()):
+            elements = self._chunk_elements.get(idx)
+            if elements is not None:
+                elements.discard(element)
+                if not elements:
+                    self._release(idx)
+
+    def chunks_of(self, element: Any) -> list[str]:
+        return [self._chunk_ids[idx] for idx in self._element_chunks.get(element, ())]
+
+    def elements_of(self, chunk_ids: list[str]) -> set:
+        found = set()
+        for c_id in chunk_ids:
+            idx = self._chunk_index.get(c_id)
+            if idx is not None:
+                found.update(self._chunk_elements.get(idx, ()))
+        return found
+
+
 @dataclass
 class NetworkXStorage(BaseGraphStorage):
     @staticmethod
@@ -309,6 +612,22 @@ class NetworkXStorage(BaseGraphStorage):
         self._node_embed_algorithms = {
             "node2vec": self._node2vec_embed,
         }
+        self._node_chunks = ChunkAdjacency()
+        self._edge_chunks = ChunkAdjacency()
+        for node_id, node_data in self._graph.nodes(data=True):
+            self._node_chunks.set(node_id, node_data.get("source_id"))
+        for src, tgt, edge_data in self._graph.edges(data=True):
+            self._edge_chunks.set(self._edge_key(src, tgt), edge_data.get("source_id"))
+
+    @staticmethod
+    def _edge_key(source_node_id: str, target_node_id: str) -> tuple[str, str]:
+        # Graph is undirected, index each edge under one orientation
+        return tuple(sorted((source_node_id, target_node_id)))
+
+    def _unindex_node(self, node_id: str):
+        self._node_chunks.remove(node_id)
+        for src, tgt in self._graph.edges(node_id):
+            self._edge_chunks.remove(self._edge_key(src, tgt))
 
     async def index_done_callback(self):
         NetworkXStorage.write_nx_graph(self._graph, self._graphml_xml_file)
@@ -340,11 +659,32 @@ class NetworkXStorage(BaseGraphStorage):
 
     async def upsert_node(self, node_id: str, node_data: dict[str, str]):
         self._graph.add_node(node_id, **node_data)
+        self._node_chunks.set(node_id, self._graph.nodes[node_id].get("source_id"))
 
     async def upsert_edge(
         self, source_node_id: str, target_node_id: str, edge_data: dict[str, str]
     ):
         self._graph.add_edge(source_node_id, target_node_id, **edge_data)
+        self._edge_chunks.set(
+            self._edge_key(source_node_id, target_node_id),
+            self._graph.edges[source_node_id, target_node_id].get("source_id"),
+        )
+
+    async def get_nodes_chunk_ids(self, node_ids: list[str]) -> list[list[str]]:
+        return [self._node_chunks.chunks_of(node_id) for node_id in node_ids]
+
+    async def get_edges_chunk_ids(
+        self, edges: list[tuple[str, str]]
+    ) -> list[list[str]]:
+        return [self._edge_chunks.chunks_of(self._edge_key(*edge)) for edge in edges]
+
+    async def get_chunks_graph_elements(
+        self, chunk_ids: list[str]
+    ) -> tuple[set[str], set[tuple[str, str]]]:
+        return (
+            self._node_chunks.elements_of(chunk_ids),
+            self._edge_chunks.elements_of(chunk_ids),
+        )
 
     async def delete_node(self, node_id: str):
         """
@@ -353,6 +693,7 @@ class NetworkXStorage(BaseGraphStorage):
         :param node_id: The node_id to delete
         """
         if self._graph.has_node(node_id):
+            self._unindex_node(node_id)
             self._graph.remove_node(node_id)
             logger.info(f"Node {node_id} deleted from the graph.")
         else:
@@ -383,6 +724,7 @@ class NetworkXStorage(BaseGraphStorage):
         """
         for node in nodes:
             if self._graph.has_node(node):
+                self._unindex_node(node)
                 self._graph.remove_node(node)
 
     def remove_edges(self, edges: list[tuple[str, str]]):
@@ -393,6 +735,7 @@ class NetworkXStorage(BaseGraphStorage):
         """
         for source, target in edges:
             if self._graph.has_edge(source, target):
+                self._edge_chunks.remove(self._edge_key(source, target))
                 self._graph.remove_edge(source, target)
 
 
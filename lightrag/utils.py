@@ -1,16 +1,23 @@
 import asyncio
+import heapq
 import html
 import io
+import itertools
 import csv
 import json
 import logging
 import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from functools import wraps
+from functools import partial, wraps
 from hashlib import md5
 from typing import Any, Union, List, Optional
 import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 
 import numpy as np
 import tiktoken
@@ -48,23 +55,146 @@ def set_logger(log_file: str):
         logger.addHandler(file_handler)
 
 
+class EmbeddingCache:
+    """Append-only on-disk embedding cache keyed by (model, md5(text)).
+
+    One file per model holds fixed-size records: the 16 byte md5 digest of
+    the text followed by the float32 vector. A truncated trailing record from
+    an interrupted write is ignored on load.
+    """
+
+    def __init__(self, working_dir: str, model: str, embedding_dim: int):
+        self.embedding_dim = embedding_dim
+        self._record = np.dtype([("key", "S16"), ("vector", "<f4", (embedding_dim,))])
+        model_slug = re.sub(r"[^0-9A-Za-z.-]+", "_", model)
+        self._file_name = os.path.join(
+            working_dir, f"embedding_cache_{model_slug}_{embedding_dim}.bin"
+        )
+        self._vectors: dict[bytes, np.ndarray] = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        if os.path.exists(self._file_name):
+            with open(self._file_name, "rb") as f:
+                raw = f.read()
+            usable = len(raw) - len(raw) % self._record.itemsize
+            records = np.frombuffer(raw[:usable], dtype=self._record)
+            self._vectors = dict(zip(records["key"].tolist(), records["vector"]))
+            logger.info(
+                f"Loaded {len(self._vectors)} cached embeddings from {self._file_name}"
+            )
+
+    async def embed(self, texts: list[str], embed_func) -> np.ndarray:
+        """Serve cached vectors and send only the misses to embed_func"""
+        result = np.empty((len(texts), self.embedding_dim), dtype=np.float32)
+        missing: dict[bytes, list[int]] = {}
+        for i, text in enumerate(texts):
+            key = md5(text.encode()).digest()
+            vector = self._vectors.get(key)
+            if vector is None:
+                missing.setdefault(key, []).append(i)
+            else:
+                result[i] = vector
+                self.hits += 1
+                self.bytes_saved += len(text.encode())
+        if not missing:
+            return result
+
+        embeddings = await embed_func([texts[rows[0]] for rows in missing.values()])
+        records = np.empty(len(missing), dtype=self._record)
+        for n, (key, rows) in enumerate(missing.items()):
+            records[n] = (key, embeddings[n])
+            result[rows] = records[n]["vector"]
+            self._vectors[key] = records[n]["vector"]
+            self.misses += len(rows)
+        with open(self._file_name, "ab") as f:
+            f.write(records.tobytes())
+        return result
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._vectors),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
 @dataclass
 class EmbeddingFunc:
     embedding_dim: int
     max_token_size: int
     func: callable
     concurrent_limit: int = 16
+    # Optional on-disk cache consulted before calling func, see EmbeddingCache
+    cache: Optional[EmbeddingCache] = None
+    # Seconds to wait for concurrent calls to coalesce into one request of up
+    # to max_batch_size texts, 0 sends every call on its own
+    batch_window: float = 0.0
+    max_batch_size: int = 32
 
     def __post_init__(self):
         if self.concurrent_limit != 0:
             self._semaphore = asyncio.Semaphore(self.concurrent_limit)
         else:
             self._semaphore = UnlimitedSemaphore()
+        self._batch: list[tuple[list[str], asyncio.Future]] = []
+        self._batch_size = 0
+        self._batch_timer: Optional[asyncio.TimerHandle] = None
 
-    async def __call__(self, *args, **kwargs) -> np.ndarray:
+    async def _call_func(self, *args, **kwargs) -> np.ndarray:
         async with self._semaphore:
             return await self.func(*args, **kwargs)
 
+    async def _embed(self, texts: list[str]) -> np.ndarray:
+        if self.batch_window <= 0 or len(texts) >= self.max_batch_size:
+            return await self._call_func(texts)
+        future = asyncio.get_running_loop().create_future()
+        if self._batch_size + len(texts) > self.max_batch_size:
+            self._flush_batch()
+        self._batch.append((texts, future))
+        self._batch_size += len(texts)
+        if self._batch_size >= self.max_batch_size:
+            self._flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = asyncio.get_running_loop().call_later(
+                self.batch_window, self._flush_batch
+            )
+        return await future
+
+    def _flush_batch(self):
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        if self._batch:
+            asyncio.ensure_future(self._run_batch(self._batch))
+            self._batch, self._batch_size = [], 0
+
+    async def _run_batch(self, batch: list[tuple[list[str], asyncio.Future]]):
+        """Send the coalesced texts in one request and scatter the rows back"""
+        try:
+            embeddings = await self._call_func([t for texts, _ in batch for t in texts])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        start = 0
+        for texts, future in batch:
+            if not future.done():
+                future.set_result(embeddings[start : start + len(texts)])
+            start += len(texts)
+
+    async def __call__(self, *args, **kwargs) -> np.ndarray:
+        if len(args) != 1 or kwargs:
+            return await self._call_func(*args, **kwargs)
+        # Query strings are one-offs, only ingestion goes through the disk cache
+        if self.cache is None or _query_embeddings.get() is not None:
+            return await self._embed(args[0])
+        return await self.cache.embed(args[0], self._embed)
+
 
 def locate_json_string_body_from_string(content: str) -> Union[str, None]:
     """Locate the JSON string body from a string"""
@@ -111,23 +241,306 @@ def compute_mdhash_id(content, prefix: str = ""):
     return prefix + md5(content.encode()).hexdigest()
 
 
+# Admission priorities, lower values are admitted first
+PRIORITY_QUERY = 0
+PRIORITY_INGEST = 10
+
+_admission_priority: ContextVar[int] = ContextVar(
+    "admission_priority", default=PRIORITY_INGEST
+)
+
+
+@contextmanager
+def admission_priority(priority: int):
+    """Run the block's rate-limited LLM/embedding calls at the given priority"""
+    token = _admission_priority.set(priority)
+    try:
+        yield
+    finally:
+        _admission_priority.reset(token)
+
+
+class AdmissionController:
+    """Admits at most max_concurrent callers at a time.
+
+    Waiting callers are queued by priority (lower first) and FIFO within a
+    priority, so interactive queries overtake queued background ingestion.
+    Slots are released even when the guarded call raises or is cancelled.
+    """
+
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max_concurrent
+        self._in_flight = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._queued = 0
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self, priority: Optional[int] = None):
+        if priority is None:
+            priority = _admission_priority.get()
+        if self._in_flight < self.max_concurrent and not self._queued:
+            self._in_flight += 1
+            self.admitted += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._queued += 1
+        start = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._queued -= 1
+            else:
+                # The slot was handed over right before cancellation, pass it on
+                self.release()
+            raise
+        waited = time.monotonic() - start
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def release(self):
+        # Hand the slot straight to the next live waiter, in_flight is unchanged
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._queued -= 1
+                future.set_result(None)
+                return
+        self._in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: Optional[int] = None):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queued
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self._in_flight,
+            "queue_depth": self.queue_depth,
+            "admitted": self.admitted,
+            "avg_wait": self.total_wait / self.admitted if self.admitted else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+def _parse_reset_seconds(value: str) -> Optional[float]:
+    """Parse a rate limit reset such as '20ms', '1.5s', '6m0s' or '30'"""
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)?", value or "")
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1, "": 1, "m": 60, "h": 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+class TokenBucketLimiter:
+    """Client-side requests/tokens per minute limiter.
+
+    Each call reserves one request and its estimated tokens up front and
+    sleeps until the buckets have refilled enough to cover the reservation,
+    so concurrent callers are spaced out in arrival order instead of bursting
+    into 429s. Estimates are reconciled with the actual usage afterwards, and
+    x-ratelimit-* response headers update the limits and remaining capacity.
+    A limit of None disables that bucket; limits only learned from headers
+    are replaced whenever the server reports new ones. Buckets start with one
+    second of capacity, a full minute on top of the refill would let the
+    first minute send about twice the quota.
+    """
+
+    def __init__(
+        self,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+        headroom: float = 0.95,
+    ):
+        # Stay slightly under the quota so clock skew doesn't cause 429s
+        self.headroom = headroom
+        self.rpm = None
+        self.tpm = None
+        self._requests = 0.0
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.set_limits(rpm, tpm)
+
+    def _capacity(self, per_minute: Optional[int]) -> float:
+        return per_minute * self.headroom if per_minute else 0.0
+
+    def set_limits(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        """Configure the quota, None leaves that limit to be learned from headers"""
+        self._refill(time.monotonic())
+        self._explicit = {"requests": rpm is not None, "tokens": tpm is not None}
+        if rpm != self.rpm:
+            self.rpm = rpm
+            self._requests = min(self._requests, self._capacity(rpm) / 60)
+        if tpm != self.tpm:
+            self.tpm = tpm
+            self._tokens = min(self._tokens, self._capacity(tpm) / 60)
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            capacity = self._capacity(self.rpm)
+            self._requests = min(capacity, self._requests + elapsed * capacity / 60)
+        if self.tpm:
+            capacity = self._capacity(self.tpm)
+            self._tokens = min(capacity, self._tokens + elapsed * capacity / 60)
+
+    def reserve(self, tokens: int = 0) -> float:
+        """Take capacity for one request, return the seconds to wait before sending"""
+        now = time.monotonic()
+        self._refill(now)
+        delay = max(0.0, self._blocked_until - now)
+        if self.rpm:
+            self._requests -= 1
+            if self._requests < 0:
+                delay = max(delay, -self._requests * 60 / self._capacity(self.rpm))
+        if self.tpm:
+            # A single request larger than the bucket only has to wait for a full one
+            self._tokens -= min(tokens, self._capacity(self.tpm))
+            if self._tokens < 0:
+                delay = max(delay, -self._tokens * 60 / self._capacity(self.tpm))
+        return delay
+
+    async def acquire(self, tokens: int = 0):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            self.throttled += 1
+            self.total_wait += delay
+            await asyncio.sleep(delay)
+
+    def reconcile(self, estimated: int, actual: Optional[int]):
+        """Correct the reserved estimate with the tokens actually used"""
+        if not self.tpm or actual is None:
+            return
+        self._refill(time.monotonic())
+        self._tokens = min(self._capacity(self.tpm), self._tokens + estimated - actual)
+
+    def update_from_headers(self, headers, status: int = 200):
+        """Apply x-ratelimit-* (and on 429 retry-after) headers of a response"""
+        now = time.monotonic()
+        self._refill(now)
+        for kind in ("requests", "tokens"):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit is None or remaining is None:
+                continue
+            try:
+                limit, remaining = int(limit), int(remaining)
+            except ValueError:
+                continue
+            attr = "rpm" if kind == "requests" else "tpm"
+            if not self._explicit[kind] and getattr(self, attr) != limit:
+                if not getattr(self, attr):
+                    setattr(self, f"_{kind}", self._capacity(limit) / 60)
+                setattr(self, attr, limit)
+            # The server also counts other clients sharing the key
+            current = getattr(self, f"_{kind}")
+            setattr(self, f"_{kind}", min(current, remaining * self.headroom))
+
+        if status == 429:
+            retry_after = _parse_reset_seconds(headers.get("retry-after")) or max(
+                _parse_reset_seconds(headers.get("x-ratelimit-reset-requests")) or 0,
+                _parse_reset_seconds(headers.get("x-ratelimit-reset-tokens")) or 0,
+            )
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+
+    def budget(self) -> Optional[float]:
+        """Fraction of the tightest bucket currently available, None when unlimited"""
+        self._refill(time.monotonic())
+        levels = [
+            level / self._capacity(limit)
+            for level, limit in ((self._requests, self.rpm), (self._tokens, self.tpm))
+            if limit
+        ]
+        if time.monotonic() < self._blocked_until:
+            levels.append(0.0)
+        return max(0.0, min(levels)) if levels else None
+
+    def stats(self) -> dict:
+        return {
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "throttled": self.throttled,
+            "total_wait": self.total_wait,
+        }
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution.
+
+    The first caller of a key runs the call in its own task and context,
+    callers arriving while it is in flight await its result (or exception)
+    and are counted in `coalesced`. If the leading caller is cancelled the
+    waiting ones retry, one of them becoming the new leader.
+    """
+
+    def __init__(self):
+        self._flights: dict[Any, asyncio.Future] = {}
+        self.coalesced = 0
+
+    async def do(self, key, func, *args, **kwargs):
+        while key in self._flights:
+            future = self._flights[key]
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        # Mark the exception retrieved even when nobody else was waiting
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._flights[key] = future
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._flights[key]
+
+
 def limit_async_func_call(max_size: int, waitting_time: float = 0.0001):
-    """Add restriction of maximum async calling times for a async func"""
+    """Add restriction of maximum async calling times for a async func
+
+    Calls are admitted through an AdmissionController exposed as the
+    `admission` attribute of the wrapped func; waitting_time is unused and
+    kept for compatibility.
+    """
 
     def final_decro(func):
-        """Not using async.Semaphore to aovid use nest-asyncio"""
-        __current_size = 0
+        admission = AdmissionController(max_size)
 
         @wraps(func)
         async def wait_func(*args, **kwargs):
-            nonlocal __current_size
-            while __current_size >= max_size:
-                await asyncio.sleep(waitting_time)
-            __current_size += 1
-            result = await func(*args, **kwargs)
-            __current_size -= 1
-            return result
+            async with admission.slot():
+                return await func(*args, **kwargs)
 
+        wait_func.admission = admission
         return wait_func
 
     return final_decro
@@ -143,6 +556,88 @@ def wrap_embedding_func_with_attrs(**kwargs):
     return final_decro
 
 
+# Per-request memo of query embeddings, only set while a query is running
+_query_embeddings: ContextVar[Optional[dict]] = ContextVar(
+    "query_embeddings", default=None
+)
+
+
+@contextmanager
+def query_embedding_scope():
+    """Share query embeddings between every lookup made inside the block"""
+    token = _query_embeddings.set({})
+    try:
+        yield
+    finally:
+        _query_embeddings.reset(token)
+
+
+async def prefetch_query_embeddings(embedding_func, texts: list[str]):
+    """Embed the strings a query plan needs in one batch, lookups then hit the memo"""
+    texts = [text for text in dict.fromkeys(texts) if text]
+    if texts and embedding_func is not None and _query_embeddings.get() is not None:
+        await embedding_func(texts)
+
+
+def memoize_query_embeddings(max_size: int = 1024):
+    """Memoize embeddings of query strings for an embedding func.
+
+    Inside query_embedding_scope each distinct string is embedded once per
+    request, concurrent lookups of the same string share one call and the
+    strings still missing are sent in a single batch. Embeddings are also kept
+    in a process-wide LRU of max_size entries (0 disables it). Outside a query
+    scope, e.g. while inserting, calls pass straight through.
+    """
+
+    def final_decro(func):
+        lru: OrderedDict[str, np.ndarray] = OrderedDict()
+
+        @wraps(func)
+        async def memo_func(texts, *args, **kwargs):
+            memo = _query_embeddings.get()
+            if memo is None or args or kwargs:
+                return await func(texts, *args, **kwargs)
+            request_memo = memo.setdefault(id(memo_func), {})
+
+            missing = []
+            for text in dict.fromkeys(texts):
+                if text in request_memo:
+                    continue
+                future = asyncio.get_running_loop().create_future()
+                request_memo[text] = future
+                if text in lru:
+                    lru.move_to_end(text)
+                    future.set_result(lru[text])
+                else:
+                    missing.append(text)
+
+            if missing:
+                try:
+                    embeddings = await func(missing)
+                except Exception as e:
+                    for text in missing:
+                        future = request_memo.pop(text)
+                        future.set_exception(e)
+                        future.exception()  # waiters still see it, no warning
+                    raise
+                for text, embedding in zip(missing, embeddings):
+                    request_memo[text].set_result(embedding)
+                    if max_size > 0:
+                        lru[text] = embedding
+                        if len(lru) > max_size:
+                            lru.popitem(last=False)
+                logger.debug(
+                    f"Embedded {len(missing)} of {len(texts)} query strings, "
+                    f"the rest came from the memo"
+                )
+
+            return np.array([await request_memo[text] for text in texts])
+
+        return memo_func
+
+    return final_decro
+
+
 def load_json(file_name):
     if not os.path.exists(file_name):
         return None
@@ -163,6 +658,14 @@ def encode_string_by_tiktoken(content: str, model_name: str = "gpt-4o"):
     return tokens
 
 
+def encode_strings_by_tiktoken(contents: list[str], model_name: str = "gpt-4o"):
+    """Encode several strings at once with tiktoken's multi-threaded batch encoder"""
+    global ENCODER
+    if ENCODER is None:
+        ENCODER = tiktoken.encoding_for_model(model_name)
+    return ENCODER.encode_batch(contents)
+
+
 def decode_tokens_by_tiktoken(tokens: list[int], model_name: str = "gpt-4o"):
     global ENCODER
     if ENCODER is None:
@@ -171,6 +674,83 @@ def decode_tokens_by_tiktoken(tokens: list[int], model_name: str = "gpt-4o"):
     return content
 
 
+class TokenizerService:
+    """Tokenize in a worker thread pool instead of on the event loop thread
+
+    Texts submitted during the same event loop iteration are encoded together
+    in one encode_batch call, tiktoken releases the GIL while encoding.
+    """
+
+    def __init__(self, model_name: str = "gpt-4o", max_workers: int = 4):
+        self.model_name = model_name
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_workers), thread_name_prefix="lightrag-tokenizer"
+        )
+        self._pending: list[tuple[list[str], asyncio.Future]] = []
+
+    def _encoder(self):
+        global ENCODER
+        if ENCODER is None:
+            ENCODER = tiktoken.encoding_for_model(self.model_name)
+        return ENCODER
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        texts = [text for batch, _ in pending for text in batch]
+        loop = asyncio.get_running_loop()
+        task = loop.run_in_executor(self._executor, self._encoder().encode_batch, texts)
+
+        def _done(task: asyncio.Future):
+            if task.exception() is not None:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(task.exception())
+                return
+            offset = 0
+            for batch, future in pending:
+                if not future.done():
+                    future.set_result(task.result()[offset : offset + len(batch)])
+                offset += len(batch)
+
+        task.add_done_callback(_done)
+
+    async def encode_batch(self, contents: list[str]) -> list[list[int]]:
+        if not contents:
+            return []
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self._pending:
+            loop.call_soon(self._flush)
+        self._pending.append((list(contents), future))
+        return await future
+
+    async def encode(self, content: str) -> list[int]:
+        return (await self.encode_batch([content]))[0]
+
+    async def run(self, func: callable, *args, **kwargs):
+        """Run a tokenization heavy function, such as a chunker, in the pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, partial(func, *args, **kwargs)
+        )
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+_tokenizer_services: dict[tuple[str, int], TokenizerService] = {}
+
+
+def get_tokenizer_service(
+    model_name: str = "gpt-4o", max_workers: int = 4
+) -> TokenizerService:
+    """Return the shared TokenizerService for a model and pool size"""
+    key = (model_name, max_workers)
+    if key not in _tokenizer_services:
+        _tokenizer_services[key] = TokenizerService(model_name, max_workers)
+    return _tokenizer_services[key]
+
+
 def pack_user_ass_to_openai_messages(*args: str):
     roles = ["user", "assistant"]
     return [
@@ -203,13 +783,26 @@ def is_float_regex(value):
     return bool(re.match(r"^[-+]?[0-9]*\.?[0-9]+$", value))
 
 
-def truncate_list_by_token_size(list_data: list, key: callable, max_token_size: int):
-    """Truncate a list of data by token size"""
+def truncate_list_by_token_size(
+    list_data: list,
+    key: callable,
+    max_token_size: int,
+    token_count: callable = None,
+):
+    """Truncate a list of data by token size
+
+    Args:
+        token_count: returns the precomputed token count of an item, items it
+            returns None for are encoded instead
+    """
     if max_token_size <= 0:
         return []
     tokens = 0
     for i, data in enumerate(list_data):
-        tokens += len(encode_string_by_tiktoken(key(data)))
+        count = token_count(data) if token_count is not None else None
+        if count is None:
+            count = len(encode_string_by_tiktoken(key(data)))
+        tokens += count
         if tokens > max_token_size:
             return list_data[:i]
     return list_data
@@ -293,43 +886,6 @@ def xml_to_json(xml_file):
         return None
 
 
-def process_combine_contexts(hl, ll):
-    header = None
-    list_hl = csv_string_to_list(hl.strip())
-    list_ll = csv_string_to_list(ll.strip())
-
-    if list_hl:
-        header = list_hl[0]
-        list_hl = list_hl[1:]
-    if list_ll:
-        header = list_ll[0]
-        list_ll = list_ll[1:]
-    if header is None:
-        return ""
-
-    if list_hl:
-        list_hl = [",".join(item[1:]) for item in list_hl if item]
-    if list_ll:
-        list_ll = [",".join(item[1:]) for item in list_ll if item]
-
-    combined_sources = []
-    seen = set()
-
-    for item in list_hl + list_ll:
-        if item and item not in seen:
-            combined_sources.append(item)
-            seen.add(item)
-
-    combined_sources_result = [",\t".join(header)]
-
-    for i, item in enumerate(combined_sources, start=1):
-        combined_sources_result.append(f"{i},\t{item}")
-
-    combined_sources_result = "\n".join(combined_sources_result)
-
-    return combined_sources_result
-
-
 async def get_best_cached_response(
     hashing_kv,
     current_embedding,
@@ -447,8 +1003,14 @@ def dequantize_embedding(
     return (quantized * scale + min_val).astype(np.float32)
 
 
-async def handle_cache(hashing_kv, args_hash, prompt, mode="default"):
-    """Generic cache handling function"""
+async def handle_cache(
+    hashing_kv, args_hash, prompt, mode="default", embedding_func=None
+):
+    """Generic cache handling function
+
+    embedding_func, when given, embeds the prompt for the semantic cache so
+    the embedding is shared with the rest of the query.
+    """
     if hashing_kv is None or not hashing_kv.global_config.get("enable_llm_cache"):
         return None, None, None, None
 
@@ -463,17 +1025,21 @@ async def handle_cache(hashing_kv, args_hash, prompt, mode="default"):
         return None, None, None, None
 
     # Get embedding cache configuration
-    embedding_cache_config = hashing_kv.global_config.get(
-        "embedding_cache_config",
-        {"enabled": False, "similarity_threshold": 0.95, "use_llm_check": False},
-    )
+    # Entity extraction switches the semantic cache off by setting it to None
+    embedding_cache_config = hashing_kv.global_config.get("embedding_cache_config") or {
+        "enabled": False,
+        "similarity_threshold": 0.95,
+        "use_llm_check": False,
+    }
     is_embedding_cache_enabled = embedding_cache_config["enabled"]
     use_llm_check = embedding_cache_config.get("use_llm_check", False)
 
     quantized = min_val = max_val = None
     if is_embedding_cache_enabled:
         # Use embedding cache
-        embedding_model_func = hashing_kv.global_config["embedding_func"]["func"]
+        embedding_model_func = (
+            embedding_func or hashing_kv.global_config["embedding_func"]["func"]
+        )
         llm_model_func = hashing_kv.global_config.get("llm_model_func")
 
         current_embedding = await embedding_model_func([prompt])
@@ -517,10 +1083,9 @@ async def save_to_cache(hashing_kv, cache_data: CacheData):
         return
 
     if exists_func(hashing_kv, "get_by_mode_and_id"):
-        mode_cache = (
-            await hashing_kv.get_by_mode_and_id(cache_data.mode, cache_data.args_hash)
-            or {}
-        )
+        # Storages addressing entries by (mode, id) upsert single entries,
+        # no need to load and rewrite the whole mode cache
+        mode_cache = {}
     else:
         mode_cache = await hashing_kv.get_by_id(cache_data.mode) or {}
 
@@ -567,3 +1132,86 @@ def exists_func(obj, func_name: str) -> bool:
         return True
     else:
         return False
+
+
+class MinHashIndex:
+    """MinHash LSH index to find near-duplicate chunks
+
+    Chunks are compared by the estimated Jaccard similarity of their word
+    3-gram shingles. Signatures are split into bands, chunks sharing a band are
+    candidates and verified against similarity_threshold.
+    """
+
+    _PRIME = (1 << 32) + 15
+
+    def __init__(self, similarity_threshold: float = 0.9, num_perm: int = 128):
+        self.similarity_threshold = similarity_threshold
+        self.num_perm = num_perm
+        rng = np.random.RandomState(1)
+        self._a = rng.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+        self._rows = self._choose_rows(similarity_threshold, num_perm)
+        self._signatures: dict[str, np.ndarray] = {}
+        self._buckets: dict[tuple, list[str]] = {}
+        # Futures of extractions still running, keyed by chunk id
+        self.inflight: dict[str, asyncio.Future] = {}
+        self.stats = {"duplicates": 0, "llm_calls_avoided": 0}
+
+    @staticmethod
+    def _choose_rows(threshold: float, num_perm: int) -> int:
+        # rows per band whose LSH threshold (1/bands)^(1/rows) is just below the target
+        best = 1
+        for rows in range(1, num_perm + 1):
+            if num_perm % rows:
+                continue
+            if (1 / (num_perm // rows)) ** (1 / rows) <= threshold:
+                best = rows
+        return best
+
+    def signature(self, content: str) -> np.ndarray:
+        words = content.lower().split()
+        shingles = {" ".join(words[i : i + 3]) for i in range(max(1, len(words) - 2))}
+        hashes = np.array(
+            [int(md5(s.encode()).hexdigest()[:8], 16) for s in shingles],
+            dtype=np.uint64,
+        )
+        permuted = (self._a[:, None] * hashes[None, :] + self._b[:, None]) % self._PRIME
+        return permuted.min(axis=1)
+
+    def _bands(self, signature: np.ndarray):
+        for start in range(0, self.num_perm, self._rows):
+            yield (start, signature[start : start + self._rows].tobytes())
+
+    def add(self, key: str, signature: np.ndarray):
+        signature = np.asarray(signature, dtype=np.uint64)
+        if key in self._signatures or len(signature) != self.num_perm:
+            return
+        self._signatures[key] = signature
+        for band in self._bands(signature):
+            self._buckets.setdefault(band, []).append(key)
+
+    def remove(self, keys: list[str]):
+        for key in keys:
+            signature = self._signatures.pop(key, None)
+            if signature is None:
+                continue
+            for band in self._bands(signature):
+                bucket = self._buckets.get(band, [])
+                if key in bucket:
+                    bucket.remove(key)
+
+    def query(self, signature: np.ndarray, exclude: str = None) -> Optional[str]:
+        """Return the most similar indexed key above the threshold, if any"""
+        candidates = set()
+        for band in self._bands(signature):
+            candidates.update(self._buckets.get(band, []))
+        candidates.discard(exclude)
+        best_key, best_similarity = None, self.similarity_threshold
+        for key in candidates:
+            similarity = float(np.mean(self._signatures[key] == signature))
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+        return best_key
+
+    def __len__(self):
+        return len(self._signatures)